@@ -0,0 +1,9 @@
+import models
+from my_async_entity import AsyncEntity, AsyncConnectionPool, async_model
+
+Section = async_model(models.Section)
+Category = async_model(models.Category)
+Post = async_model(models.Post)
+Comment = async_model(models.Comment)
+Tag = async_model(models.Tag)
+User = async_model(models.User)
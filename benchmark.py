@@ -0,0 +1,228 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+import psycopg2
+
+from models import Entity, Category, Comment, Post, QueryCounter
+
+# ops/sec, p50/p99 latency, queries and peak memory per operation of the ORM hot paths
+# every size is loaded from schema.sql into its own "benchmark" schema which is dropped afterwards,
+# so the database is not changed:
+#     python benchmark.py --rows 1000 100000 1000000 --output results.json
+# compare two versions of the code:
+#     python benchmark.py --output new.json --compare old.json
+
+
+def load_schema(db):
+    cursor = db.cursor()
+    cursor.execute('DROP SCHEMA IF EXISTS benchmark CASCADE')
+    cursor.execute('CREATE SCHEMA benchmark')
+    cursor.execute('SET search_path TO benchmark')
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql'), encoding='utf8') as file:
+        cursor.execute(file.read())
+    db.commit()
+
+
+def drop_schema(db):
+    db.rollback()
+    cursor = db.cursor()
+    cursor.execute('DROP SCHEMA IF EXISTS benchmark CASCADE')
+    cursor.execute('SET search_path TO DEFAULT')
+    db.commit()
+
+
+def fill(db, count):
+    # count posts and comments, a category per 100 posts, a user per 100 comments and one tag per post
+    groups = max(count // 100, 1)
+    cursor = db.cursor()
+    cursor.execute("INSERT INTO section (section_title) SELECT 'section ' || i FROM generate_series(1, 10) AS i")
+    cursor.execute("INSERT INTO category (category_title, section_id) "
+                   "SELECT 'category ' || i, 1 + i %% 10 FROM generate_series(1, %s) AS i", (groups,))
+    cursor.execute('INSERT INTO "user" (user_name, user_email) '
+                   "SELECT 'user ' || i, 'user' || i || '@example.com' FROM generate_series(1, %s) AS i", (groups,))
+    cursor.execute("INSERT INTO tag (tag_name) SELECT 'tag ' || i FROM generate_series(1, 100) AS i")
+    cursor.execute("INSERT INTO post (post_title, post_content, category_id) "
+                   "SELECT 'title ' || i, 'content ' || i, 1 + i %% %s FROM generate_series(1, %s) AS i",
+                   (groups, count))
+    cursor.execute("INSERT INTO comment (comment_text, post_id, user_id) "
+                   "SELECT 'comment ' || i, 1 + i %% %s, 1 + i %% %s FROM generate_series(1, %s) AS i",
+                   (count, groups, count))
+    cursor.execute("INSERT INTO post__tag (post_id, tag_id) SELECT i, 1 + i %% 100 FROM generate_series(1, %s) AS i",
+                   (count,))
+    cursor.execute('ANALYZE')
+    db.commit()
+
+
+def measure(operation, ops):
+    # time every call separately, then repeat one call to count its queries and trace its peak memory
+    operation()
+    latencies = []
+    for _ in range(ops):
+        Entity.clear_identity_map()
+        started = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - started)
+
+    Entity.clear_identity_map()
+    gc.collect()
+    tracemalloc.start()
+    with QueryCounter() as counter:
+        operation()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'ops': ops,
+        'ops_per_sec': ops / sum(latencies),
+        'p50_ms': latencies[int(0.50 * (ops - 1))] * 1000,
+        'p99_ms': latencies[int(0.99 * (ops - 1))] * 1000,
+        'queries_per_op': counter.count,
+        'peak_memory_bytes': peak,
+    }
+
+
+def operations(count, ops):
+    # (group, name, operation, number of timed calls)
+    groups = max(count // 100, 1)
+    created = []
+    loaded = Post(1)
+    loaded.title
+
+    def create():
+        post = Post()
+        post.title = 'benchmark'
+        post.content = 'benchmark'
+        post.category = Category(1)
+        post.save()
+        created.append(post.id)
+
+    def read():
+        Post(random.randint(1, count)).title
+
+    def update():
+        post = Post(random.randint(1, count))
+        post.title = 'updated'
+        post.save()
+
+    def delete():
+        Post(created.pop()).delete()
+
+    def getattr_1000():
+        for _ in range(1000):
+            loaded.title
+
+    def parent():
+        Comment(random.randint(1, count)).post.title
+
+    def children():
+        Category(random.randint(1, groups)).posts
+
+    def siblings():
+        Post(random.randint(1, count)).tags
+
+    def prefetch():
+        start = random.randint(0, max(count - 1000, 0))
+        comments = Comment.query().filter(id__gt=start).order_by('id').limit(1000).all()
+        Entity.prefetch(comments, 'post', 'user')
+
+    def select_related():
+        start = random.randint(0, max(count - 1000, 0))
+        Comment.query().select_related('post', 'user').filter(id__gt=start).order_by('id').limit(1000).all()
+
+    def filter_page():
+        Post.query().filter(category=random.randint(1, groups)).order_by('-id').limit(20).all()
+
+    # reads of whole tables are repeated less often, each of them touches every row
+    scans = max(min(ops // 10, 1000000 // count * 5), 3)
+    return [
+        ('crud', 'create', create, ops),
+        ('crud', 'read', read, ops),
+        ('crud', 'update', update, ops),
+        ('crud', 'delete', delete, ops),
+        ('crud', 'getattr x1000', getattr_1000, ops),
+        ('relations', 'parent', parent, ops),
+        ('relations', 'children', children, ops),
+        ('relations', 'siblings', siblings, ops),
+        ('relations', 'prefetch 1000', prefetch, max(ops // 10, 3)),
+        ('relations', 'select_related 1000', select_related, max(ops // 10, 3)),
+        ('bulk', 'filter page', filter_page, ops),
+        ('bulk', 'all()', Post.all, scans),
+        ('bulk', 'all(rows=True)', lambda: Post.all(rows=True), scans),
+        ('bulk', 'iter_all()', lambda: sum(1 for _ in Post.iter_all(batch_size=2000)), scans),
+    ]
+
+
+def environment(db):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'postgres': db.server_version,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def compare(results, previous_path):
+    # print the change of ops/sec against results of another run
+    with open(previous_path, encoding='utf8') as file:
+        previous = {(r['rows'], r['name']): r for r in json.load(file)['results']}
+
+    for result in results:
+        before = previous.get((result['rows'], result['name']))
+        if before is not None:
+            change = (result['ops_per_sec'] / before['ops_per_sec'] - 1) * 100
+            print(f"{result['rows']:>9} {result['name']:<22}{before['ops_per_sec']:>12.1f} -> "
+                  f"{result['ops_per_sec']:>12.1f} ops/sec {change:>+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--ops', type=int, default=200, help='timed calls of every single row operation')
+    parser.add_argument('--dsn', default='dbname=orm_base user=user password=pass host=127.0.0.1 port=5433')
+    parser.add_argument('--output', help='write results as json')
+    parser.add_argument('--compare', help='json results of a previous run')
+    options = parser.parse_args()
+
+    random.seed(0)
+    Entity.db = psycopg2.connect(options.dsn)
+    results = []
+    try:
+        for count in options.rows:
+            load_schema(Entity.db)
+            fill(Entity.db, count)
+            Entity.clear_identity_map()
+
+            for group, name, operation, ops in operations(count, options.ops):
+                result = dict(group=group, name=name, rows=count, **measure(operation, ops))
+                results.append(result)
+                print(f"{count:>9} {name:<22}{result['ops_per_sec']:>12.1f} ops/sec "
+                      f"p50 {result['p50_ms']:>9.3f} ms p99 {result['p99_ms']:>9.3f} ms "
+                      f"{result['queries_per_op']:>5} queries {result['peak_memory_bytes'] / 1024:>10.1f} KiB")
+            drop_schema(Entity.db)
+            Entity.clear_identity_map()
+
+        if options.output:
+            with open(options.output, 'w', encoding='utf8') as file:
+                json.dump({'environment': environment(Entity.db), 'results': results}, file, indent=2)
+        if options.compare:
+            compare(results, options.compare)
+    finally:
+        drop_schema(Entity.db)
+        Entity.db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import gc
+import tracemalloc
+
+import psycopg2
+from psycopg2.extras import DictCursor
+
+from benchmark import drop_schema, load_schema
+from models import Entity, Post
+
+# bytes per loaded post for full instances, read-only rows and bare driver rows
+# synthetic rows are inserted into a throwaway benchmark schema which is dropped at the end, so the database is not changed
+# run it on two versions of the code to compare them:
+#     python benchmark_memory.py --rows 100000 --dsn "dbname=orm_base user=user password=pass host=127.0.0.1 port=5433"
+
+
+def fill(db, count):
+    cursor = db.cursor()
+    cursor.execute('INSERT INTO section (section_title) VALUES (%s) RETURNING section_id', ('benchmark',))
+    section_id = cursor.fetchone()[0]
+    cursor.execute('INSERT INTO category (category_title, section_id) VALUES (%s, %s) RETURNING category_id',
+                   ('benchmark', section_id))
+    category_id = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO post (post_title, post_content, category_id) "
+                   "SELECT 'title ' || i, 'content ' || i, %s FROM generate_series(1, %s) AS i",
+                   (category_id, count))
+    db.commit()
+
+
+def measure(load):
+    # return a number of loaded objects and bytes allocated per object
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = load()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return len(result), (after - before) / max(len(result), 1)
+
+
+def driver_rows(db):
+    cursor = db.cursor(cursor_factory=DictCursor)
+    cursor.execute('SELECT * FROM post')
+    return cursor.fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--dsn', default='dbname=orm_base user=user password=pass host=127.0.0.1 port=5433')
+    options = parser.parse_args()
+
+    Entity.db = psycopg2.connect(options.dsn)
+    try:
+        load_schema(Entity.db)
+        fill(Entity.db, options.rows)
+
+        loaders = [
+            ('DictCursor rows', lambda: driver_rows(Entity.db)),
+            ('Post.all()', Post.all),
+            ('Post.all(rows=True)', lambda: Post.all(rows=True)),
+        ]
+
+        for title, load in loaders:
+            count, size = measure(load)
+            print(f'{title:<24}{count:>10} objects {size:>10.1f} bytes/object')
+    finally:
+        drop_schema(Entity.db)
+        Entity.db.close()
+
+
+if __name__ == '__main__':
+    main()
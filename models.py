@@ -3,6 +3,7 @@ from my_entity import *
 
 
 class Section(Entity):
+    __slots__ = ()
     _columns = ['title']
     _parents = []
     _children = {'categories': 'Category'}
@@ -10,6 +11,7 @@ class Section(Entity):
 
 
 class Category(Entity):
+    __slots__ = ()
     _columns = ['title']
     _parents = ['section']
     _children = {'posts': 'Post'}
@@ -17,6 +19,7 @@ class Category(Entity):
 
 
 class Post(Entity):
+    __slots__ = ()
     _columns = ['content', 'title']
     _parents = ['category']
     _children = {'comments': 'Comment'}
@@ -24,6 +27,7 @@ class Post(Entity):
 
 
 class Comment(Entity):
+    __slots__ = ()
     _columns = ['text']
     _parents = ['post', 'user']
     _children = {}
@@ -31,6 +35,7 @@ class Comment(Entity):
 
 
 class Tag(Entity):
+    __slots__ = ()
     _columns = ['name']
     _parents = []
     _children = {}
@@ -38,6 +43,7 @@ class Tag(Entity):
 
 
 class User(Entity):
+    __slots__ = ()
     _columns = ['name', 'email', 'age']
     _parents = []
     _children = {'comments': 'Comment'}
@@ -0,0 +1,391 @@
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import DictCursor
+
+from my_entity import DatabaseError, NotFoundError, ModifiedError, RuntimeException
+
+
+async def wait(conn):
+    # wait for an asynchronous psycopg2 connection without blocking the event loop
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+
+        future = loop.create_future()
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(conn.fileno(), future.set_result, None)
+            try:
+                await future
+            finally:
+                loop.remove_reader(conn.fileno())
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(conn.fileno(), future.set_result, None)
+            try:
+                await future
+            finally:
+                loop.remove_writer(conn.fileno())
+        else:
+            raise DatabaseError(f'bad poll state: {state}')
+
+
+class AsyncConnectionPool(object):
+    # bounded pool of asynchronous psycopg2 connections
+    # every connection runs one statement at a time, so independent queries run concurrently
+    # on different connections, e.g. with asyncio.gather
+
+    def __init__(self, maxconn, *args, **kwargs):
+        self.__maxconn = maxconn
+        self.__args = args
+        self.__kwargs = kwargs
+        self.__idle = []
+        self.__opened = 0
+        self.__released = None
+
+    async def getconn(self):
+        if self.__released is None:
+            self.__released = asyncio.Condition()
+
+        async with self.__released:
+            while not self.__idle and self.__opened >= self.__maxconn:
+                await self.__released.wait()
+            if self.__idle:
+                return self.__idle.pop()
+            self.__opened += 1
+
+        conn = None
+        try:
+            conn = psycopg2.connect(*self.__args, async_=True, **self.__kwargs)
+            await wait(conn)
+            return conn
+        except BaseException as e:
+            # a failed or cancelled connect gives its slot back
+            if conn is not None:
+                conn.close()
+            async with self.__released:
+                self.__opened -= 1
+                self.__released.notify()
+            if isinstance(e, Exception):
+                raise DatabaseError from e
+            raise
+
+    async def putconn(self, conn):
+        async with self.__released:
+            if conn.closed:
+                self.__opened -= 1
+            else:
+                self.__idle.append(conn)
+            self.__released.notify()
+
+    @asynccontextmanager
+    async def connection(self):
+        conn = await self.getconn()
+        try:
+            yield conn
+        finally:
+            await self.putconn(conn)
+
+    def closeall(self):
+        for conn in self.__idle:
+            conn.close()
+        self.__opened -= len(self.__idle)
+        self.__idle = []
+
+
+class AsyncEntity(object):
+    # asyncio flavor of my_entity.Entity, declared with the same _columns, _parents, _children and _siblings
+    # columns are read synchronously from loaded instances, relations are awaited:
+    #     post = await Post.get(1)
+    #     category = await post.category
+    #     async for comment in Comment.iter_all():
+    pool = None
+
+    __registry = {}
+    __connection = contextvars.ContextVar('async_entity_connection', default=None)
+
+    __delete_query = 'DELETE FROM "{table}" WHERE {table}_id=%s'
+    __insert_query = 'INSERT INTO "{table}" ({columns}) VALUES ({placeholders}) RETURNING *'
+    __list_query = 'SELECT * FROM "{table}"'
+    __page_query = 'SELECT * FROM "{table}" WHERE {table}_id > %s ORDER BY {table}_id LIMIT %s'
+    __select_query = 'SELECT * FROM "{table}" WHERE {table}_id=%s'
+    __update_query = 'UPDATE "{table}" SET {columns} WHERE {table}_id=%s RETURNING {table}_updated'
+
+    __parent_query = 'SELECT * FROM "{table}" WHERE {parent}_id = ANY(%s)'
+    __sibling_query = 'SELECT * FROM "{sibling}" NATURAL JOIN "{join_table}" WHERE {table}_id = ANY(%s)'
+    __select_many_query = 'SELECT * FROM "{table}" WHERE {table}_id = ANY(%s)'
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        AsyncEntity.__registry[cls.__name__] = cls
+        cls.__table = cls.__name__.lower()
+
+        kinds = {}
+        kinds.update((name, 'siblings') for name in getattr(cls, '_siblings', {}))
+        kinds.update((name, 'children') for name in getattr(cls, '_children', {}))
+        kinds.update((name, 'parent') for name in getattr(cls, '_parents', []))
+        kinds.update((name, 'column') for name in getattr(cls, '_columns', []))
+        cls.__kinds = kinds
+
+    def __init__(self, id=None):
+        self.__fields = {}
+        self.__changed = set()
+        self.__id = id
+        self.__loaded = False
+        self.__related = {}
+
+    def __getattr__(self, name):
+        # columns are returned from loaded fields, relations return an awaitable
+        kind = self.__kinds.get(name)
+        if kind == 'column':
+            if self.__changed:
+                raise ModifiedError
+            if not self.__loaded:
+                raise RuntimeException(f'{self.__class__.__name__} is not loaded, await load() first')
+            return self.__fields[f'{self.__table}_{name}']
+        elif kind == 'parent':
+            return self.__get_parent(name)
+        elif kind in ('children', 'siblings'):
+            return self.__get_related(name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        kind = self.__kinds.get(name)
+        if kind == 'column':
+            self.__fields[f'{self.__table}_{name}'] = value
+            self.__changed.add(f'{self.__table}_{name}')
+        elif kind == 'parent':
+            self.__fields[f'{name}_id'] = value.id
+            self.__changed.add(f'{name}_id')
+            self.__related[name] = value
+        elif kind in ('children', 'siblings'):
+            raise RuntimeException(f'{name} can only be changed with the blocking Entity')
+        else:
+            super(AsyncEntity, self).__setattr__(name, value)
+
+    @property
+    def id(self):
+        return self.__id
+
+    @property
+    def created(self):
+        return self.__fields[f'{self.__table}_created']
+
+    @property
+    def updated(self):
+        return self.__fields[f'{self.__table}_updated']
+
+    @classmethod
+    async def get(cls, id):
+        # return a loaded instance or raise NotFoundError
+        obj = cls(id)
+        await obj.load()
+        return obj
+
+    @classmethod
+    async def get_many(cls, ids):
+        # return loaded instances for all ids with one query
+        rows = await cls._execute(cls.__select_many_query.format(table=cls.__table), (list(ids),))
+        return [cls.__hydrate(row) for row in rows]
+
+    async def load(self):
+        if not self.__loaded:
+            rows = await self._execute(self.__select_query.format(table=self.__table), (self.__id,))
+            if not rows:
+                raise NotFoundError
+            self.__fields.update((k, v) for k, v in rows[0].items() if k not in self.__changed)
+            self.__loaded = True
+        return self
+
+    async def save(self):
+        # insert or update changed fields, nothing is executed if there are none
+        if not self.__changed:
+            return self
+
+        if not self.__id:
+            keys = list(self.__fields.keys())
+            query = self.__insert_query.format(table=self.__table, columns=", ".join(keys),
+                                               placeholders=", ".join(["%s"] * len(keys)))
+            rows = await self._execute(query, tuple(self.__fields[k] for k in keys))
+            self.__fields = dict(rows[0])
+            self.__id = self.__fields[f'{self.__table}_id']
+            self.__loaded = True
+        else:
+            keys = sorted(self.__changed)
+            query = self.__update_query.format(table=self.__table, columns=", ".join(f'{k}=%s' for k in keys))
+            rows = await self._execute(query, tuple(self.__fields[k] for k in keys) + (self.__id,))
+            if rows:
+                self.__fields[f'{self.__table}_updated'] = rows[0][0]
+
+        self.__changed.clear()
+        return self
+
+    async def delete(self):
+        if not self.__id:
+            raise RuntimeException
+        await self._execute(self.__delete_query.format(table=self.__table), (self.__id,))
+
+    @classmethod
+    async def all(cls):
+        rows = await cls._execute(cls.__list_query.format(table=cls.__table), ())
+        return [cls.__hydrate(row) for row in rows]
+
+    @classmethod
+    async def iter_all(cls, batch_size=1000):
+        # yield instances page by page ordered by id, only batch_size rows are held in memory at a time
+        # asynchronous connections can't use server-side cursors, so keyset pagination is used instead
+        last_id = 0
+        query = cls.__page_query.format(table=cls.__table)
+        while True:
+            rows = await cls._execute(query, (last_id, batch_size))
+            for row in rows:
+                yield cls.__hydrate(row)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][f'{cls.__table}_id']
+
+    @classmethod
+    async def prefetch(cls, instances, *names):
+        # load relations for a whole list of instances, one query per relation
+        # independent relations are loaded concurrently on different connections
+        instances = [obj for obj in instances if obj.__id is not None]
+        if instances:
+            await asyncio.gather(*(type(instances[0]).__prefetch_one(instances, name) for name in names))
+        return instances
+
+    @classmethod
+    @asynccontextmanager
+    async def transaction(cls):
+        # run every statement inside the block on one connection in one transaction
+        # nested blocks join the outer transaction
+        # statements of one transaction can't overlap, so concurrent ones wait for each other
+        if AsyncEntity.__connection.get() is not None:
+            yield
+            return
+
+        async with cls.pool.connection() as conn:
+            lock = asyncio.Lock()
+            token = AsyncEntity.__connection.set((conn, lock))
+            try:
+                await cls.__run(conn, 'BEGIN', ())
+                try:
+                    yield
+                except BaseException:
+                    await cls.__rollback(conn, lock)
+                    raise
+                await cls.__run(conn, 'COMMIT', ())
+            finally:
+                AsyncEntity.__connection.reset(token)
+
+    @classmethod
+    async def __rollback(cls, conn, lock):
+        # roll back a failed transaction keeping the original error,
+        # a connection which can't be rolled back is closed, so the pool never reuses it with the transaction open
+        if conn.closed:
+            return
+        try:
+            async with lock:
+                await cls.__run(conn, 'ROLLBACK', ())
+        except (Exception, asyncio.CancelledError):
+            conn.close()
+
+    @classmethod
+    async def _execute(cls, query, args):
+        # execute a statement on the connection of the current transaction or on a pooled one
+        # return all its rows
+        current = AsyncEntity.__connection.get()
+        if current is not None:
+            conn, lock = current
+            async with lock:
+                return await cls.__run(conn, query, args)
+
+        if cls.pool is None:
+            raise DatabaseError()
+        async with cls.pool.connection() as conn:
+            return await cls.__run(conn, query, args)
+
+    @classmethod
+    async def __run(cls, conn, query, args):
+        try:
+            cursor = conn.cursor(cursor_factory=DictCursor)
+            cursor.execute(query, args)
+            await wait(conn)
+            return cursor.fetchall() if cursor.description else []
+        except psycopg2.Error as e:
+            raise DatabaseError from e
+        except BaseException:
+            # cancelled while the statement runs, e.g. by asyncio.wait_for: the connection can't execute
+            # anything until the result is read, so it is closed and the pool drops it instead of reusing it
+            conn.close()
+            raise
+
+    async def __get_parent(self, name):
+        if name not in self.__related:
+            await self.load()
+            self.__related[name] = await self.__entity_class(name.capitalize()).get(self.__fields[f'{name}_id'])
+        return self.__related[name]
+
+    async def __get_related(self, name):
+        if name not in self.__related:
+            await self.__prefetch_one([self], name)
+        if not self.__related[name]:
+            raise NotFoundError
+        return self.__related[name]
+
+    @classmethod
+    async def __prefetch_one(cls, instances, name):
+        table_name = cls.__table
+        ids = list({obj.__id for obj in instances})
+        kind = cls.__kinds.get(name)
+
+        if kind == 'parent':
+            my_cls = cls.__entity_class(name.capitalize())
+            await asyncio.gather(*(obj.load() for obj in instances))
+            loaded = {obj.id: obj for obj in await my_cls.get_many({obj.__fields[f'{name}_id'] for obj in instances})}
+            for obj in instances:
+                obj.__related[name] = loaded.get(obj.__fields[f'{name}_id'])
+            return
+
+        if kind == 'children':
+            my_cls = cls.__entity_class(cls._children[name])
+            query = cls.__parent_query.format(table=my_cls.__table, parent=table_name)
+        elif kind == 'siblings':
+            my_cls = cls.__entity_class(cls._siblings[name])
+            join_table = '__'.join(sorted([table_name, my_cls.__table]))
+            query = cls.__sibling_query.format(sibling=my_cls.__table, join_table=join_table, table=table_name)
+        else:
+            raise AttributeError(name)
+
+        grouped = {row_id: [] for row_id in ids}
+        for row in await cls._execute(query, (ids,)):
+            grouped[row[f'{table_name}_id']].append(my_cls.__hydrate(row))
+        for obj in instances:
+            obj.__related[name] = grouped[obj.__id]
+
+    @classmethod
+    def __hydrate(cls, row):
+        obj = cls(row[f'{cls.__table}_id'])
+        obj.__fields = row
+        obj.__loaded = True
+        return obj
+
+    @classmethod
+    def __entity_class(cls, name):
+        if name not in AsyncEntity.__registry:
+            __import__('async_models')
+        return AsyncEntity.__registry[name]
+
+
+def async_model(model):
+    # build an AsyncEntity subclass from a blocking model declaration, e.g. async_model(models.Post)
+    return type(model.__name__, (AsyncEntity,), {
+        '_columns': list(model._columns),
+        '_parents': list(model._parents),
+        '_children': dict(model._children),
+        '_siblings': dict(model._siblings),
+        '__module__': 'async_models',
+    })
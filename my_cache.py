@@ -0,0 +1,155 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryBackend(object):
+    # in-process cache storage with LRU eviction of at most maxsize values and per value expiry
+    # any object with get(key), set(key, value, ttl), incr(key) and counter(key) can be used as a backend instead
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.__values = OrderedDict()
+        self.__counters = {}
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        # return a stored value or None, the value becomes the most recently used one
+        with self.__lock:
+            item = self.__values.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires <= time.monotonic():
+                del self.__values[key]
+                return None
+            self.__values.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.__lock:
+            self.__values[key] = (value, None if ttl is None else time.monotonic() + ttl)
+            self.__values.move_to_end(key)
+            while len(self.__values) > self.maxsize:
+                self.__values.popitem(last=False)
+
+    def incr(self, key):
+        # counters are kept apart from values, so they are never evicted
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + 1
+            return self.__counters[key]
+
+    def counter(self, key):
+        with self.__lock:
+            return self.__counters.get(key, 0)
+
+    def clear(self):
+        with self.__lock:
+            self.__values.clear()
+            self.__counters.clear()
+
+    def __len__(self):
+        return len(self.__values)
+
+
+class FakeRedis(object):
+    # in-memory stand-in for a redis.Redis client implementing the few commands RedisBackend uses,
+    # values are kept as bytes like a real server does
+    def __init__(self):
+        self.__data = {}
+        self.__lock = threading.Lock()
+
+    def get(self, name):
+        with self.__lock:
+            item = self.__data.get(name)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires <= time.monotonic():
+                del self.__data[name]
+                return None
+            return value
+
+    def set(self, name, value, ex=None):
+        if not isinstance(value, bytes):
+            value = str(value).encode()
+        with self.__lock:
+            self.__data[name] = (value, None if ex is None else time.monotonic() + ex)
+        return True
+
+    def incr(self, name):
+        with self.__lock:
+            value, expires = self.__data.get(name, (b'0', None))
+            value = int(value) + 1
+            self.__data[name] = (str(value).encode(), expires)
+            return value
+
+    def flushdb(self):
+        with self.__lock:
+            self.__data.clear()
+        return True
+
+    def dbsize(self):
+        return len(self.__data)
+
+
+class RedisBackend(object):
+    # cache storage in redis shared by every process, client is a redis.Redis or a FakeRedis
+    # values are pickled, eviction is left to the server (e.g. maxmemory-policy allkeys-lru) and ttl
+
+    def __init__(self, client, prefix='my_entity:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + repr(key))
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + repr(key), pickle.dumps(value), ex=ttl)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + repr(key))
+
+    def counter(self, key):
+        value = self.client.get(self.prefix + repr(key))
+        return 0 if value is None else int(value)
+
+
+class ResultCache(object):
+    # read-through cache of fetched rows in front of Entity reads, set it as Entity.cache:
+    #     Entity.cache = ResultCache(MemoryBackend(maxsize=50000), ttl=60)
+    # values are keyed by (table, id, relation, selected columns) and by a generation of every table
+    # they are read from;
+    # a write to a table bumps its generation, so all values read from it are missed from then on
+    # and are evicted later by LRU or ttl
+    def __init__(self, backend=None, ttl=300):
+        self.backend = MemoryBackend() if backend is None else backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+
+    def fetch(self, key, tables, load):
+        # return a cached value for key or call load() and cache its result
+        versioned = (key, tuple(self.backend.counter(('generation', table)) for table in tables))
+        value = self.backend.get(versioned)
+        if value is not None:
+            with self.__lock:
+                self.hits += 1
+            return value
+
+        with self.__lock:
+            self.misses += 1
+        value = load()
+        self.backend.set(versioned, value, self.ttl)
+        return value
+
+    def invalidate(self, table):
+        # forget every value read from table
+        self.backend.incr(('generation', table))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'ratio': self.hits / total if total else 0.0}
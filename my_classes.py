@@ -1,3 +1,8 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
 import yaml
 
 
@@ -13,109 +18,138 @@ class ValueRelationException(Exception):
     pass
 
 
+class IndexColumnException(Exception):
+    pass
+
+
+# tables are lower case names in yaml order, fields map a table to its (column, type) pairs,
+# relations map a table to its ('one', parent table, None) and ('many', sibling table, pivot table) relations,
+# pivots map a pivot table to its (first, second) primary key tables and indexes map a table to declared index columns
+RelationGraph = namedtuple('RelationGraph', ['tables', 'fields', 'relations', 'pivots', 'indexes'])
+
+
 def parse_yaml_schema(yaml_schema_path: str) -> dict:
     with open(yaml_schema_path) as file:
         return yaml.safe_load(file)
 
 
-def write_to_file(sql_schema_path: str, queries: list):
-    with open(sql_schema_path, 'a', encoding='utf8') as file:
+def write_to_file(sql_schema_path: str, queries, mode='a'):
+    with open(sql_schema_path, mode, encoding='utf8') as file:
         for query in queries:
             file.write(query + "\n \n")
 
 
 class Generator:
-    """Generator create sql statement from yaml schema and create triggers for tables"""
+    """Generator create sql statement from yaml schema and create triggers for tables
+
+    The yaml schema is validated and turned into a RelationGraph in one pass, every emitter reads the graph.
+    generate_scheme returns all statements, iter_scheme yields them one by one to stream them into a file
+    and write_shards splits them into files by tables, optionally generated by a process pool.
+    """
 
     def __init__(self, raw_dict):
         self.__queries = []
         self.__raw_dict = raw_dict
-
-    def create_sql_queries(self):
-
-        for table in self.__raw_dict:
-            table_name_query = f'CREATE TABLE "{table.lower()}"'
-            body_query = []
-            body_query.append(f'\n    "{table.lower()}_id" SERIAL PRIMARY KEY')
-            for column_name, column_type in self.__raw_dict[table]['fields'].items():
-                body_query.append(f'\n    "{table.lower()}_{column_name}" {column_type}')
-            body_query.append(f'\n    "{table.lower()}_created" '
-                              f'INTEGER NOT NULL DEFAULT cast(extract(epoch from now()) AS INTEGER)')
-            body_query.append(f'\n    "{table.lower()}_updated" '
-                              f'INTEGER NOT NULL DEFAULT cast(extract(epoch from now()) AS INTEGER)')
-            self.__queries.append(f"{table_name_query} ({','.join(body_query)}\n);")
-
-    def create_triggers(self):
-        for table in self.__raw_dict:
-            trigger_body = f'CREATE OR REPLACE FUNCTION update_{table.lower()}_timestamp()\n' \
-                           f'RETURNS TRIGGER AS $$\n' \
-                           f'BEGIN\n' \
-                           f'    NEW.{table.lower()}_updated = cast(extract(epoch from now()) as integer);\n' \
-                           f'    RETURN NEW;\n' \
-                           f'END;\n' \
-                           f'$$ language "plpgsql";\n' \
-                           f'CREATE TRIGGER "tr_{table.lower()}_updated" BEFORE UPDATE ON "{table.lower()}" ' \
-                           f'FOR EACH ROW EXECUTE PROCEDURE update_{table.lower()}_timestamp();'
-            self.__queries.append(trigger_body)
-
-    def validate_schema(self):
-        one = 'one'
-        many = 'many'
-        relation_values = (one, many)
-
-        for table in self.__raw_dict:
-            for relation_table, relation_value in self.__raw_dict[table]['relations'].items():
+        self.__graph = None
+
+    def relation_graph(self) -> RelationGraph:
+        # validate the yaml schema and resolve tables, columns, relations and indexes once
+        if self.__graph is not None:
+            return self.__graph
+
+        tables = []
+        fields = {}
+        relations = {}
+        pivots = {}
+        indexes = {}
+        foreign_keys = {}
+
+        for table, description in self.__raw_dict.items():
+            name = table.lower()
+            tables.append(name)
+            fields[name] = [(f'{name}_{column_name}', column_type)
+                            for column_name, column_type in description['fields'].items()]
+            relations[name] = []
+            foreign_keys[name] = set()
+
+            for relation_table, relation_value in description['relations'].items():
                 if relation_table == table:
                     raise SelfRelationException(f"Duplicate table: {relation_table} and {table}")
-                if relation_value not in relation_values:
+                if relation_value not in ('one', 'many'):
                     raise ValueRelationException(f"Relation value: '{relation_value}' isn't correct")
+                reverse_value = self.__raw_dict.get(relation_table, {}).get('relations', {}).get(table)
+                if reverse_value is None:
+                    raise PairRelationException(f"Relation: {table} - {relation_table} has no pair")
+
+                relation_name = relation_table.lower()
+                if relation_value == 'one':
+                    foreign_keys[name].add(f'{relation_name}_id')
+                    if reverse_value == 'many':
+                        relations[name].append(('one', relation_name, None))
+                elif reverse_value == 'many':
+                    pivot_name = '__'.join(sorted([name, relation_name]))
+                    pivots.setdefault(pivot_name, (name, relation_name))
+                    relations[name].append(('many', relation_name, pivot_name))
+
+        for table, description in self.__raw_dict.items():
+            name = table.lower()
+            columns = {f'{name}_{column}' for column in ['id', 'created', 'updated']}
+            columns.update(column for column, _ in fields[name])
+            columns.update(foreign_keys[name])
+
+            # a declared index the generator creates anyway (a foreign key index or a repeated declaration)
+            # would get the same name, so it is skipped; pivot indexes are on pivot tables, which declare none
+            indexed = {(f'{relation_table}_id',) for kind, relation_table, _ in relations[name] if kind == 'one'}
+            indexes[name] = []
+            for index in description.get('indexes', []):
+                index_columns = self.__index_columns(table, index)
+                for column in index_columns:
+                    if column not in columns:
+                        raise IndexColumnException(f"Index column: '{column}' isn't in {table}")
+                if tuple(index_columns) not in indexed:
+                    indexed.add(tuple(index_columns))
+                    indexes[name].append(index_columns)
+
+        self.__graph = RelationGraph(tables, fields, relations, pivots, indexes)
+        return self.__graph
 
-    def one_to_many(self):
-        for table in self.__raw_dict:
-            for relation_table, relation_value in self.__raw_dict[table]['relations'].items():
+    def validate_schema(self):
+        self.relation_graph()
 
-                if relation_value == 'one' and self.__raw_dict[relation_table]['relations'][table] == 'many':
-                    one_to_many = f'ALTER TABLE "{table.lower()}" ADD "{relation_table.lower()}_id" INTEGER NOT NULL, ' \
-                                    f'\n    ADD CONSTRAINT "fk_{table.lower()}_{relation_table.lower()}_id" ' \
-                                    f'FOREIGN KEY ("{relation_table.lower()}_id") ' \
-                                    f'REFERENCES "{relation_table.lower()}" ("{relation_table.lower()}_id");'
-                    self.__queries.append(one_to_many)
+    def create_sql_queries(self):
+        self.__queries.extend(self.__table_query(table) for table in self.relation_graph().tables)
 
-    def many_to_many(self):
-        for table in self.__raw_dict:
-            for relation_table, relation_value in self.__raw_dict[table]['relations'].items():
+    def create_triggers(self):
+        self.__queries.extend(self.__trigger_query(table) for table in self.relation_graph().tables)
 
-                if relation_value == 'many' and self.__raw_dict[relation_table]['relations'][table] == 'many':
+    def one_to_many(self):
+        graph = self.relation_graph()
+        for table in graph.tables:
+            self.__queries.extend(self.__foreign_key_query(table, relation_table)
+                                  for kind, relation_table, _ in graph.relations[table] if kind == 'one')
 
-                    many_to_many = f'ALTER TABLE "{table.lower()}__{relation_table.lower()}"\n    ' \
-                                    f'ADD CONSTRAINT "fk_{table.lower()}__{relation_table.lower()}_{table.lower()}_id" ' \
-                                    f'FOREIGN KEY ("{table.lower()}_id")' \
-                                    f' REFERENCES "{table.lower()}" ("{table.lower()}_id");'
-                    self.__queries.append(many_to_many)
+    def many_to_many(self):
+        graph = self.relation_graph()
+        for table in graph.tables:
+            self.__queries.extend(self.__pivot_foreign_key_query(pivot_name, table)
+                                  for kind, _, pivot_name in graph.relations[table] if kind == 'many')
 
     def create_pivot_table(self):
-        handled_tables_name = set()
-
-        for table in self.__raw_dict:
-            for relation_table, relation_value in self.__raw_dict[table]['relations'].items():
+        graph = self.relation_graph()
+        self.__queries.extend(self.__pivot_table_query(pivot_name, *columns)
+                              for pivot_name, columns in graph.pivots.items())
 
-                if relation_value == 'many' and self.__raw_dict[relation_table]['relations'][table] == 'many':
-                    pivot_name = '__'.join(sorted([table.lower(), relation_table.lower()]))
-                    if pivot_name in handled_tables_name:
-                        continue
-
-                    table_query = f'CREATE TABLE "{pivot_name}" (' \
-                                    f'\n    "{table.lower()}_id" INTEGER NOT NULL,' \
-                                    f'\n    "{relation_table.lower()}_id" INTEGER NOT NULL,' \
-                                    f'\n    PRIMARY KEY ("{table.lower()}_id", "{relation_table.lower()}_id")\n);'
-
-                    handled_tables_name.add(f"{pivot_name}")
-                    self.__queries.append(table_query)
+    def create_indexes(self):
+        # foreign keys and the second column of a pivot primary key can't use any other index,
+        # so lookups of children and reverse lookups of siblings would scan whole tables
+        for table in self.relation_graph().tables:
+            self.__queries.extend(self.__index_queries(table))
 
     def change_table(self):
         self.create_pivot_table()
         self.one_to_many()
         self.many_to_many()
+        self.create_indexes()
 
     def generate_scheme(self):
         self.validate_schema()
@@ -124,6 +158,150 @@ class Generator:
         self.create_triggers()
         return self.__queries
 
+    def iter_scheme(self):
+        # yield the statements of generate_scheme one by one without keeping them
+        graph = self.relation_graph()
+        for table in graph.tables:
+            yield self.__table_query(table)
+        for pivot_name, columns in graph.pivots.items():
+            yield self.__pivot_table_query(pivot_name, *columns)
+        for table in graph.tables:
+            for kind, relation_table, _ in graph.relations[table]:
+                if kind == 'one':
+                    yield self.__foreign_key_query(table, relation_table)
+        for table in graph.tables:
+            for kind, _, pivot_name in graph.relations[table]:
+                if kind == 'many':
+                    yield self.__pivot_foreign_key_query(pivot_name, table)
+        for table in graph.tables:
+            yield from self.__index_queries(table)
+        for table in graph.tables:
+            yield self.__trigger_query(table)
+
+    def write_shards(self, directory, shards=1, processes=None):
+        # write the scheme into tables_<n>.sql and relations_<n>.sql files, every table goes to one of the shards;
+        # tables files create tables, pivot tables and triggers and have to run before all relations files,
+        # which add foreign keys and indexes
+        # with processes the shards are generated by a pool of processes
+        graph = self.relation_graph()
+        os.makedirs(directory, exist_ok=True)
+        shards = max(min(shards, len(graph.tables)), 1)
+
+        if not processes:
+            return [path for shard in range(shards) for path in self.write_shard(directory, shard, shards)]
+
+        with ProcessPoolExecutor(processes, initializer=_set_shard_generator, initargs=(self,)) as executor:
+            written = executor.map(_write_shard, repeat(directory), range(shards), repeat(shards))
+            return [path for paths in written for path in paths]
+
+    def write_shard(self, directory, shard, shards):
+        graph = self.relation_graph()
+        tables = graph.tables[shard::shards]
+        tables_path = os.path.join(directory, f'tables_{shard:04d}.sql')
+        relations_path = os.path.join(directory, f'relations_{shard:04d}.sql')
+
+        write_to_file(tables_path, self.__shard_table_queries(tables), mode='w')
+        write_to_file(relations_path, self.__shard_relation_queries(tables), mode='w')
+        return [tables_path, relations_path]
+
+    def __shard_table_queries(self, tables):
+        graph = self.relation_graph()
+        for table in tables:
+            yield self.__table_query(table)
+            for kind, _, pivot_name in graph.relations[table]:
+                if kind == 'many' and graph.pivots[pivot_name][0] == table:
+                    yield self.__pivot_table_query(pivot_name, *graph.pivots[pivot_name])
+            yield self.__trigger_query(table)
+
+    def __shard_relation_queries(self, tables):
+        graph = self.relation_graph()
+        for table in tables:
+            for kind, relation_table, pivot_name in graph.relations[table]:
+                if kind == 'one':
+                    yield self.__foreign_key_query(table, relation_table)
+                else:
+                    yield self.__pivot_foreign_key_query(pivot_name, table)
+            yield from self.__index_queries(table)
+
+    def __table_query(self, table):
+        body_query = [f'\n    "{table}_id" SERIAL PRIMARY KEY']
+        body_query.extend(f'\n    "{column}" {column_type}'
+                          for column, column_type in self.relation_graph().fields[table])
+        body_query.append(f'\n    "{table}_created" '
+                          f'INTEGER NOT NULL DEFAULT cast(extract(epoch from now()) AS INTEGER)')
+        body_query.append(f'\n    "{table}_updated" '
+                          f'INTEGER NOT NULL DEFAULT cast(extract(epoch from now()) AS INTEGER)')
+        return f'CREATE TABLE "{table}" ({",".join(body_query)}\n);'
+
+    @staticmethod
+    def __trigger_query(table):
+        return f'CREATE OR REPLACE FUNCTION update_{table}_timestamp()\n' \
+               f'RETURNS TRIGGER AS $$\n' \
+               f'BEGIN\n' \
+               f'    NEW.{table}_updated = greatest(cast(extract(epoch from now()) as integer), OLD.{table}_updated + 1);\n' \
+               f'    RETURN NEW;\n' \
+               f'END;\n' \
+               f'$$ language "plpgsql";\n' \
+               f'CREATE TRIGGER "tr_{table}_updated" BEFORE UPDATE ON "{table}" ' \
+               f'FOR EACH ROW EXECUTE PROCEDURE update_{table}_timestamp();'
+
+    @staticmethod
+    def __foreign_key_query(table, relation_table):
+        return f'ALTER TABLE "{table}" ADD "{relation_table}_id" INTEGER NOT NULL, ' \
+               f'\n    ADD CONSTRAINT "fk_{table}_{relation_table}_id" ' \
+               f'FOREIGN KEY ("{relation_table}_id") ' \
+               f'REFERENCES "{relation_table}" ("{relation_table}_id");'
+
+    @staticmethod
+    def __pivot_table_query(pivot_name, table, relation_table):
+        return f'CREATE TABLE "{pivot_name}" (' \
+               f'\n    "{table}_id" INTEGER NOT NULL,' \
+               f'\n    "{relation_table}_id" INTEGER NOT NULL,' \
+               f'\n    PRIMARY KEY ("{table}_id", "{relation_table}_id")\n);'
+
+    @staticmethod
+    def __pivot_foreign_key_query(pivot_name, table):
+        return f'ALTER TABLE "{pivot_name}"\n    ' \
+               f'ADD CONSTRAINT "fk_{pivot_name}_{table}_id" ' \
+               f'FOREIGN KEY ("{table}_id")' \
+               f' REFERENCES "{table}" ("{table}_id");'
+
+    def __index_queries(self, table):
+        graph = self.relation_graph()
+        for kind, relation_table, pivot_name in graph.relations[table]:
+            if kind == 'one':
+                yield self.__index_query(table, [f'{relation_table}_id'])
+            elif graph.pivots[pivot_name][0] == table:
+                yield self.__index_query(pivot_name, [f'{relation_table}_id'])
+        for columns in graph.indexes[table]:
+            yield self.__index_query(table, columns)
+
+    @staticmethod
+    def __index_query(table, columns):
+        index_name = f'ix_{table}_{"_".join(columns)}'
+        index_columns = ", ".join(f'"{column}"' for column in columns)
+        return f'CREATE INDEX "{index_name}" ON "{table}" ({index_columns});'
+
+    @staticmethod
+    def __index_columns(table, index):
+        # an index is declared as a column name or a list of them, e.g. title or [title, created]
+        # a name of a related table stands for its foreign key column
+        names = [index] if isinstance(index, str) else index
+        return [f'{name.lower()}_id' if name[:1].isupper() else f'{table.lower()}_{name}' for name in names]
+
+
+_shard_generator = None
+
+
+def _set_shard_generator(generator):
+    # initializer of pool processes, the generator with its graph is sent to every process once
+    global _shard_generator
+    _shard_generator = generator
+
+
+def _write_shard(directory, shard, shards):
+    return _shard_generator.write_shard(directory, shard, shards)
+
 
 schema_task_three = 'schema_task_3.yml'
 sql_file_task_three = 'sql_schema_3.sql'
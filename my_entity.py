@@ -1,6 +1,22 @@
+import itertools
+import logging
+import threading
+import time
+import weakref
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from operator import itemgetter
+
 import psycopg2
-from psycopg2.extras import DictCursor
+import psycopg2.pool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import DictCursor, execute_values
+
+logger = logging.getLogger(__name__)
 
+# statement is the sql string without arguments, duration is in seconds,
+# rowcount is -1 when it is not known yet (server-side cursors)
+QueryEvent = namedtuple('QueryEvent', ['statement', 'param_count', 'duration', 'rowcount', 'entity'])
 
 class DatabaseError(Exception):
     pass
@@ -18,36 +34,411 @@ class RuntimeException(Exception):
     pass
 
 
+class ConflictError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    # bounded pool of psycopg2 connections, safe to share between threads
+    # getconn blocks while all maxconn connections are checked out, at most checkout_timeout seconds
+    # unless another timeout is given, None waits forever
+    # any object with getconn() and putconn(conn) can be used as Entity.pool instead
+
+    def __init__(self, minconn, maxconn, *args, checkout_timeout=30, **kwargs):
+        self.__pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, *args, **kwargs)
+        self.__slots = threading.BoundedSemaphore(maxconn)
+        self.checkout_timeout = checkout_timeout
+
+    def getconn(self, timeout=None):
+        if timeout is None:
+            timeout = self.checkout_timeout
+        if not self.__slots.acquire(timeout=timeout):
+            raise DatabaseError('connection pool is exhausted')
+        try:
+            return self.__pool.getconn()
+        except Exception as e:
+            self.__slots.release()
+            raise DatabaseError from e
+
+    def putconn(self, conn, close=False):
+        # an unfinished transaction is rolled back by psycopg2 before the connection is reused
+        self.__pool.putconn(conn, close=close)
+        self.__slots.release()
+
+    def closeall(self):
+        self.__pool.closeall()
+
+
+class ReplicaRouter(object):
+    # sends reads issued outside sessions to streaming replicas, the primary stays Entity.db or Entity.pool:
+    #     Entity.db = psycopg2.connect(primary_dsn)
+    #     Entity.replicas = ReplicaRouter([replica1_dsn, replica2_dsn], strategy='least_loaded')
+    # round_robin takes replicas in turn, least_loaded the one running fewest statements of this process
+    # after a write the thread reads from the primary for pin_seconds, so it sees its own writes despite
+    # replication lag; a replica failing with a connection error is skipped for retry_seconds
+    strategies = ('round_robin', 'least_loaded')
+
+    def __init__(self, dsns, strategy='round_robin', pin_seconds=5, retry_seconds=30, connect=psycopg2.connect):
+        if strategy not in self.strategies:
+            raise ValueError(f'unknown strategy: {strategy}')
+        self.dsns = list(dsns)
+        self.strategy = strategy
+        self.pin_seconds = pin_seconds
+        self.retry_seconds = retry_seconds
+        self.__connect = connect
+        self.__idle = {dsn: [] for dsn in self.dsns}
+        self.__active = dict.fromkeys(self.dsns, 0)
+        self.__down = dict.fromkeys(self.dsns, 0.0)
+        self.__turn = itertools.count()
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def pin(self):
+        # read from the primary for the next pin_seconds in the current thread
+        self.__local.pinned = time.monotonic() + self.pin_seconds
+
+    def pinned(self):
+        return getattr(self.__local, 'pinned', 0.0) > time.monotonic()
+
+    def getconn(self):
+        # return (dsn, connection) of a chosen replica or None when none of them is available
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                available = [dsn for dsn in self.dsns if self.__down[dsn] <= now]
+                if not available:
+                    return None
+                start = next(self.__turn) % len(available)
+                available = available[start:] + available[:start]
+                if self.strategy == 'least_loaded':
+                    available.sort(key=self.__active.get)
+                dsn = available[0]
+                self.__active[dsn] += 1
+                db = self.__idle[dsn].pop() if self.__idle[dsn] else None
+
+            if db is not None:
+                return dsn, db
+            try:
+                db = self.__connect(dsn)
+                # reads are never committed, autocommit keeps replicas free of idle transactions
+                db.autocommit = True
+                return dsn, db
+            except psycopg2.Error as e:
+                logger.warning('replica is not available, it is skipped for %s s: %s', self.retry_seconds, e)
+                self.__fail(dsn)
+
+    def putconn(self, dsn, db, failed=False):
+        # give a connection back, a failed one is closed and its replica is skipped for retry_seconds
+        if failed:
+            db.close()
+            self.__fail(dsn)
+            return
+        with self.__lock:
+            self.__active[dsn] -= 1
+            self.__idle[dsn].append(db)
+
+    def load(self):
+        # return a number of running statements per replica
+        with self.__lock:
+            return dict(self.__active)
+
+    def closeall(self):
+        with self.__lock:
+            for idle in self.__idle.values():
+                for db in idle:
+                    db.close()
+                idle.clear()
+
+    def __fail(self, dsn):
+        with self.__lock:
+            self.__active[dsn] -= 1
+            self.__down[dsn] = time.monotonic() + self.retry_seconds
+            idle, self.__idle[dsn] = self.__idle[dsn], []
+        for db in idle:
+            db.close()
+
+
+class _Checkout(object):
+    # a connection checked out from a pool by a thread, it goes back to the pool when released
+    # or when the thread ends and this holder is collected
+    __slots__ = ('db', 'release', '__weakref__')
+
+    def __init__(self, db, pool):
+        self.db = db
+        self.release = weakref.finalize(self, _Checkout.give_back, db, pool)
+
+    @staticmethod
+    def give_back(db, pool):
+        Entity.clear_identity_map(db)
+        pool.putconn(db)
+
+
+class _ThreadKey(object):
+    # identity map key of a thread that reads with Entity.pool set but has no connection checked out,
+    # it lives in thread-local data, so the map goes away with the thread
+    __slots__ = ('__weakref__',)
+
+
+class Session(object):
+    # unit of work: collects modified entities and commits all their statements at once
+    # use it as a context manager, on error everything is rolled back
+    # when Entity.pool is set the session uses a connection of the current thread
+    # or checks out its own one until it exits
+    __local = threading.local()
+
+    def __init__(self, db=None):
+        self.db = db
+        self.__pooled = False
+        if self.db is None and Entity.pool is None:
+            self.db = Entity.db
+            if self.db is None:
+                raise DatabaseError()
+
+        # an insertion-ordered dict keyed by instance, entities hash by identity
+        self.__dirty = {}
+        self.__written = set()
+        self.__previous = None
+
+    def __enter__(self):
+        if self.db is None:
+            self.db = Entity.thread_connection()
+            if self.db is None:
+                self.db = Entity.pool.getconn()
+                self.__pooled = True
+        self.__previous = Session.current()
+        Session.__local.session = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            Session.__local.session = self.__previous
+            if self.__pooled:
+                Entity.clear_identity_map(self.db)
+                Entity.pool.putconn(self.db)
+                self.db = None
+                self.__pooled = False
+        return False
+
+    @classmethod
+    def current(cls):
+        # return a session of the current thread or None
+        return getattr(cls.__local, 'session', None)
+
+    def add(self, entity):
+        # remember a modified entity, it will be saved on flush
+        self.__dirty[entity] = None
+
+    def discard(self, entity):
+        self.__dirty.pop(entity, None)
+
+    def written(self, tables):
+        # remember tables changed in the session, values read from them are dropped from Entity.cache
+        # once more on commit or rollback, because they could have been cached before the session ended
+        self.__written.update(tables)
+
+    def flush(self):
+        # save every modified entity without committing
+        # entities are saved in the order they were added, saving one may add more
+        while self.__dirty:
+            dirty, self.__dirty = list(self.__dirty), {}
+            for i, entity in enumerate(dirty):
+                try:
+                    entity.save()
+                except Exception:
+                    self.__dirty.update(dict.fromkeys(dirty[i + 1:]))
+                    raise
+
+    def commit(self):
+        try:
+            self.flush()
+        except Exception:
+            self.rollback()
+            raise
+
+        try:
+            self.db.commit()
+        except Exception as e:
+            self.rollback()
+            raise DatabaseError from e
+        # writes become visible on replicas only after the commit, so reads are pinned from then on
+        if Entity.replicas is not None:
+            Entity.replicas.pin()
+        self.__invalidate()
+
+    def rollback(self):
+        self.__dirty = {}
+        Entity.clear_identity_map(self.db)
+        self.db.rollback()
+        self.__invalidate()
+
+    def __invalidate(self):
+        tables, self.__written = self.__written, set()
+        if Entity.cache is not None:
+            for table in tables:
+                Entity.cache.invalidate(table)
+
+
+class Row(tuple):
+    # read-only row of an entity table kept in a plain tuple
+    # every entity class generates a subclass per column layout with a property for each column,
+    # so all rows of a result share one column-index map
+    __slots__ = ()
+    _entity = None
+    _columns = ()
+
+    def as_dict(self):
+        return dict(zip(self._columns, self))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({", ".join(f"{k}={v!r}" for k, v in zip(self._columns, self))})'
+
+
+class QueryCounter(object):
+    # counts statements executed by the current thread inside the block, e.g. to catch N+1 regressions:
+    #     with QueryCounter() as counter:
+    #         render_page()
+    #     assert counter.count <= 3
+    __local = threading.local()
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.events = []
+
+    def __enter__(self):
+        QueryCounter.__local.counters = QueryCounter.active() + (self,)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        QueryCounter.__local.counters = tuple(c for c in QueryCounter.active() if c is not self)
+        return False
+
+    @classmethod
+    def active(cls):
+        # return counters of the current thread
+        return getattr(cls.__local, 'counters', ())
+
+    def add(self, event):
+        self.count += 1
+        self.duration += event.duration
+        self.events.append(event)
+
+
 class Entity(object):
+    # instance state lives in slots; a model declaring __slots__ = () has no per-instance __dict__
+    __slots__ = ('__fields', '__changed', '__id', '__loaded', '__modified',
+                 '__children', '__siblings', '__prefetched', '__deferred', '__annotations', '__weakref__')
+
     db = None
+    pool = None
+    replicas = None
+    cache = None
+    prepare_statements = False
+    # with optimistic locking an update or a delete of a loaded instance only succeeds if the row still has
+    # the <table>_updated version the instance loaded, otherwise ConflictError is raised
+    optimistic_locking = False
+
+    __local = threading.local()
+    __types = {}
+    __cursor_names = itertools.count()
+    __identity_maps = weakref.WeakKeyDictionary()
+    __identity_maps_lock = threading.Lock()
+    __registry = {}
+    __hooks = []
+    __prepared_names = {}
+    __prepared = weakref.WeakKeyDictionary()
+    __prepared_lock = threading.Lock()
 
     # ORM part 1
     __delete_query = 'DELETE FROM "{table}" WHERE {table}_id=%s'
     __insert_query = 'INSERT INTO "{table}" ({columns}) VALUES ({placeholders}) RETURNING "{table}_id"'
-    __insert_sibling_query = 'INSERT INTO "{table}" ({columns}) VALUES {multiple_placeholders}'
-    __list_query = 'SELECT * FROM "{table}"'
-    __select_query = 'SELECT * FROM "{table}" WHERE {table}_id=%s'
+    __sync_sibling_query = 'WITH removed AS (' \
+                           'DELETE FROM "{table}" WHERE {owner}_id=%s AND NOT ({sibling}_id = ANY(%s::integer[])) ' \
+                           'RETURNING 1' \
+                           '), added AS (' \
+                           'INSERT INTO "{table}" ({owner}_id, {sibling}_id) ' \
+                           'SELECT %s::integer, unnest(%s::integer[]) ON CONFLICT DO NOTHING RETURNING 1' \
+                           ') SELECT (SELECT count(*) FROM removed), (SELECT count(*) FROM added)'
+    __list_query = 'SELECT {columns} FROM "{table}"'
+    __select_query = 'SELECT {columns} FROM "{table}" WHERE {table}_id=%s'
+    __select_many_query = 'SELECT {columns} FROM "{table}" WHERE {table}_id = ANY(%s)'
+    __deferred_query = 'SELECT {table}_id, {columns} FROM "{table}" WHERE {table}_id = ANY(%s)'
     __update_query = 'UPDATE "{table}" SET {columns} WHERE {table}_id=%s'
+    __versioned_update_query = 'UPDATE "{table}" SET {columns} WHERE {table}_id=%s AND {table}_updated=%s ' \
+                               'RETURNING {table}_updated'
+    __versioned_delete_query = 'DELETE FROM "{table}" WHERE {table}_id=%s AND {table}_updated=%s'
+    __delete_many_query = 'DELETE FROM "{table}" WHERE {table}_id = ANY(%s)'
+    __cascade_delete_query = 'DELETE FROM "{table}" WHERE {owner}_id {match}'
+    __cascade_match = 'IN (SELECT "{table}".{table}_id FROM "{table}" WHERE {owner}_id {match})'
 
     # ORM part 2
-    __parent_query = 'SELECT * FROM "{table}" WHERE {parent}_id=%s'
-    __sibling_query = 'SELECT * FROM "{sibling}" NATURAL JOIN "{join_table}" WHERE {table}_id=%s'
-    __update_children = 'UPDATE "{table}" SET {parent}_id=%s WHERE {table}_id IN ({children})'
+    __parent_query = 'SELECT {columns} FROM "{table}" WHERE {parent}_id=%s'
+    __sibling_query = 'SELECT {columns} FROM "{sibling}" NATURAL JOIN "{join_table}" WHERE {table}_id=%s'
+    __update_children = 'UPDATE "{table}" SET {parent}_id=%s WHERE {table}_id = ANY(%s)'
+
+    # prefetch
+    __prefetch_parent_query = 'SELECT {columns} FROM "{table}" WHERE {table}_id = ANY(%s)'
+    __prefetch_children_query = 'SELECT {columns} FROM "{table}" WHERE {parent}_id = ANY(%s)'
+    __prefetch_sibling_query = 'SELECT {columns} FROM "{sibling}" NATURAL JOIN "{join_table}" ' \
+                               'WHERE {table}_id = ANY(%s)'
+
+    # aggregates
+    __annotate_query = 'SELECT {owner} AS owner_id, {aggregates} FROM {source} WHERE {owner} = ANY(%s) GROUP BY {owner}'
+
+    # bulk
+    __bulk_insert_query = 'INSERT INTO "{table}" ({columns}) VALUES %s RETURNING *'
+    __bulk_update_query = 'UPDATE "{table}" SET {columns} FROM (VALUES %s) AS data ({names}) ' \
+                          'WHERE "{table}".{table}_id = data.{table}_id ' \
+                          'RETURNING "{table}".{table}_id, "{table}".{table}_updated'
+    __versioned_bulk_update_query = 'UPDATE "{table}" SET {columns} FROM (VALUES %s) AS data ({names}, version) ' \
+                                    'WHERE "{table}".{table}_id = data.{table}_id ' \
+                                    'AND (data.version IS NULL OR "{table}".{table}_updated = data.version) ' \
+                                    'RETURNING "{table}".{table}_id, "{table}".{table}_updated'
+    __column_types_query = 'SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute ' \
+                           'WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum'
+
+    # copy
+    __copy_out_query = 'COPY "{table}" ({columns}) TO STDOUT WITH (FORMAT {format}{header})'
+    __copy_in_query = 'COPY "{table}" ({columns}) FROM STDIN WITH (FORMAT {format}{header})'
+    __sequence_query = 'SELECT setval(pg_get_serial_sequence(\'"{table}"\', \'{table}_id\'), ' \
+                       'coalesce(max({table}_id), 0) + 1, false) FROM "{table}"'
+
+    def __init_subclass__(cls, **kwargs):
+        # resolve per class metadata once: table name, kind of every attribute and a cache for sql strings
+        super().__init_subclass__(**kwargs)
+        Entity.__registry[cls.__name__] = cls
+        cls.__table = cls.__name__.lower()
+        cls.__sql_cache = {}
+        cls.__row_classes = {}
+
+        kinds = {}
+        kinds.update((name, 'siblings') for name in getattr(cls, '_siblings', {}))
+        kinds.update((name, 'children') for name in getattr(cls, '_children', {}))
+        kinds.update((name, 'parent') for name in getattr(cls, '_parents', []))
+        kinds.update((name, 'column') for name in getattr(cls, '_columns', []))
+        cls.__kinds = kinds
+        # _deferred columns are left out of selects and loaded on first access, see _get_column
+        cls.__deferred_keys = tuple(f'{cls.__table}_{name}' for name in getattr(cls, '_deferred', []))
 
     def __init__(self, id=None):
-        if self.__class__.db is None:
+        if self.__class__.db is None and Entity.pool is None:
             raise DatabaseError()
 
-        self.__cursor = self.__class__.db.cursor(
-            cursor_factory=psycopg2.extras.DictCursor
-        )
         self.__fields = {}
+        self.__changed = None
         self.__id = id
         self.__loaded = False
         self.__modified = False
-        self.__table = self.__class__.__name__.lower()
-        self.__children = {}
-        self.__siblings = {}
+        self.__children = None
+        self.__siblings = None
+        self.__prefetched = None
+        self.__deferred = None
+        self.__annotations = None
 
     def __getattr__(self, name):
         # check, if instance is modified and throw an exception
@@ -56,19 +447,25 @@ class Entity(object):
         #    columns, parents, children or siblings and call corresponding
         #    getter with name as an argument
         # throw an exception, if attribute is unrecognized
+        # values of Query.annotate and Entity.annotate are returned as they are
+        annotations = self.__annotations
+        if annotations is not None and name in annotations:
+            return annotations[name]
+
         if self.__modified:
             raise ModifiedError
 
-        if name in self._columns:
-            self.__load()
+        kind = self.__kinds.get(name)
+        if kind == 'column':
+            self.__load(name)
             return self._get_column(name)
-        elif name in self._parents:
+        elif kind == 'parent':
             self.__load()
             return self._get_parent(name)
-        elif name in self._children:
+        elif kind == 'children':
             self.__load()
             return self._get_children(name)
-        elif name in self._siblings:
+        elif kind == 'siblings':
             self.__load()
             return self._get_siblings(name)
         else:
@@ -78,32 +475,347 @@ class Entity(object):
         # check, if requested property name is in current class
         #    columns, parents, children or siblings and call corresponding
         #    setter with name and value as arguments or use default implementation
-        if name in self._parents:
+        kind = self.__kinds.get(name)
+        if kind == 'parent':
             self._set_parent(name, value)
-            self.__modified = True
-        elif name in self._columns:
+            self.__mark_modified()
+        elif kind == 'column':
             self._set_column(name, value)
-            self.__modified = True
-        elif name in self._siblings:
+            self.__mark_modified()
+        elif kind == 'siblings':
             self._set_siblings(name, value)
-            self.__modified = True
-        elif name in self._children:
+            self.__mark_modified()
+        elif kind == 'children':
             self._set_children(name, value)
-            self.__modified = True
+            self.__mark_modified()
         else:
             super(Entity, self).__setattr__(name, value)
 
-    def __execute_query(self, query, args):
-        print(f'{query}    {args}')
-        # execute an sql statement and handle exceptions together with transactions
+    def __mark_modified(self):
+        # inside a session modified instances are saved when the session commits
+        self.__modified = True
+        session = Session.current()
+        if session is not None:
+            session.add(self)
+
+    def __execute_query(self, query, args, read=False):
+        cursor = self.__execute(query, args, read)
+        self.__modified = False
+        return cursor
+
+    @classmethod
+    def __execute(cls, query, args, read=False, cursor_factory=DictCursor):
+        # execute an sql statement and return a cursor with the result
+        # reads go to Entity.replicas if it is set, see __execute_replica
+        started = cls.__instrumented() and time.perf_counter()
+        cursor = cls.__execute_replica(query, args, cursor_factory) if read else None
+        if cursor is None:
+            with cls.__statement(read, cursor_factory=cursor_factory) as cursor:
+                cls.__run(cursor, query, args)
+        if started:
+            cls.__notify(query, len(args), started, cursor.rowcount)
+        return cursor
+
+    @classmethod
+    def __run(cls, cursor, query, args):
+        if Entity.prepare_statements:
+            cls.__execute_prepared(cursor, query, args)
+        else:
+            cursor.execute(query, args)
+
+    @classmethod
+    def __execute_replica(cls, query, args, cursor_factory):
+        # run a read on a replica and return its cursor, or None to run it on the primary:
+        # there are no replicas, a session is active, the thread wrote recently or a replica failed
+        router = Entity.replicas
+        if router is None or Session.current() is not None or router.pinned():
+            return None
+
+        checked_out = router.getconn()
+        if checked_out is None:
+            return None
+
+        dsn, db = checked_out
         try:
-            self.__cursor.execute(query, args)
-            self.db.commit()
-            self.__modified = False
+            cursor = db.cursor(cursor_factory=cursor_factory)
+            cls.__run(cursor, query, args)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            logger.warning('replica failed, reading from the primary: %s', e)
+            router.putconn(dsn, db, failed=True)
+            return None
+        except psycopg2.Error as e:
+            router.putconn(dsn, db)
+            raise DatabaseError from e
+        router.putconn(dsn, db)
+        return cursor
+
+    @classmethod
+    def add_query_hook(cls, hook):
+        # hook is called with a QueryEvent after every executed statement
+        Entity.__hooks.append(hook)
+
+    @classmethod
+    def remove_query_hook(cls, hook):
+        Entity.__hooks.remove(hook)
+
+    @classmethod
+    def __instrumented(cls):
+        # timing is skipped entirely unless somebody listens
+        return bool(Entity.__hooks) or bool(QueryCounter.active()) or logger.isEnabledFor(logging.DEBUG)
+
+    @classmethod
+    def __notify(cls, query, param_count, started, rowcount):
+        # pass a statement event to counters, hooks and the module logger
+        event = QueryEvent(query, param_count, time.perf_counter() - started, rowcount, cls)
+        for counter in QueryCounter.active():
+            counter.add(event)
+        for hook in Entity.__hooks:
+            hook(event)
+        logger.debug('%s [%d params, %.3f ms, %d rows, %s]', event.statement, event.param_count,
+                     event.duration * 1000, event.rowcount, cls.__name__)
+
+    @classmethod
+    def __execute_prepared(cls, cursor, query, args):
+        # run a statement as a server-side prepared statement, it is prepared once per connection
+        with Entity.__prepared_lock:
+            name = Entity.__prepared_names.get(query)
+            if name is None:
+                name = f'orm_statement_{len(Entity.__prepared_names)}'
+                Entity.__prepared_names[query] = name
+            if cursor.connection not in Entity.__prepared:
+                Entity.__prepared[cursor.connection] = set()
+            prepared = Entity.__prepared[cursor.connection]
+
+        if name not in prepared:
+            numbered = query % tuple(f'${i}' for i in range(1, len(args) + 1))
+            cursor.execute(f'PREPARE {name} AS {numbered}')
+            prepared.add(name)
+
+        if args:
+            cursor.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(args))})', args)
+        else:
+            cursor.execute(f'EXECUTE {name}')
+
+    @classmethod
+    def __sql(cls, template, **kwargs):
+        # format a statement template once per class and arguments, later calls reuse the string
+        key = (template, tuple(kwargs.items()))
+        query = cls.__sql_cache.get(key)
+        if query is None:
+            query = template.format(**kwargs)
+            cls.__sql_cache[key] = query
+        return query
+
+    @classmethod
+    def __entity_class(cls, name):
+        # return an Entity subclass by its name, models are imported only if it is not known yet
+        if name not in Entity.__registry:
+            __import__('models')
+        return Entity.__registry[name]
+
+    @classmethod
+    def __execute_values(cls, query, rows, template=None, page_size=100):
+        # execute a multi-row statement, VALUES %s is expanded into page_size rows per round trip
+        # return all rows from RETURNING
+        started = cls.__instrumented() and time.perf_counter()
+        with cls.__statement() as cursor:
+            result = execute_values(cursor, query, rows, template=template, page_size=page_size, fetch=True)
+        if started:
+            cls.__notify(query, len(rows), started, len(result))
+        return result
+
+    @classmethod
+    def _fetch(cls, query, args, related=(), deferred=(), annotations=()):
+        # execute a select statement and return an array of instances filled with its rows
+        # related are parents joined by Query.select_related, see __hydrate_related
+        # deferred are keys of columns left out of the select, annotations are names of Query.annotate columns
+        if related:
+            cursor = cls.__execute(query, args, read=True, cursor_factory=None)
+            bounds = cls.__related_bounds(cursor.description, related)
+            group = [] if deferred else None
+            return [cls.__hydrate_related(row, bounds, group, annotations) for row in cursor.fetchall()]
+
+        cursor = cls.__execute(query, args, read=True)
+        return cls.__hydrate_rows(cursor.fetchall(), deferred, annotations)
+
+    @classmethod
+    def _fetch_rows(cls, query, args):
+        # execute a select statement and return read-only Row tuples instead of instances
+        cursor = cls.__execute(query, args, read=True, cursor_factory=None)
+        row_class = cls.__row_class(tuple(column.name for column in cursor.description))
+        return [row_class(row) for row in cursor.fetchall()]
+
+    @classmethod
+    def __row_class(cls, columns):
+        # return a Row subclass for a column layout, <table>_<name> columns are available as <name>
+        row_class = cls.__row_classes.get(columns)
+        if row_class is None:
+            prefix = f'{cls.__table}_'
+            attributes = {'__slots__': (), '_entity': cls, '_columns': columns}
+            for i, column in enumerate(columns):
+                name = column[len(prefix):] if column.startswith(prefix) else column
+                attributes.setdefault(name, property(itemgetter(i)))
+            row_class = type(f'{cls.__name__}Row', (Row,), attributes)
+            cls.__row_classes[columns] = row_class
+        return row_class
+
+    @classmethod
+    def _scalar(cls, query, args):
+        # execute a select statement and return the first column of its first row
+        return cls._fetch_one(query, args)[0]
+
+    @classmethod
+    def _fetch_one(cls, query, args):
+        # execute a select statement and return its first row
+        cursor = cls.__execute(query, args, read=True)
+        return cursor.fetchone()
+
+    @classmethod
+    def _stream(cls, query, args, batch_size=1000, related=(), deferred=(), annotations=()):
+        # execute a select statement on a server-side cursor and yield instances,
+        # only batch_size rows are held in memory at a time
+        # the cursor is declared WITH HOLD, so commits of other statements don't close it
+        name = f'{cls.__table}_stream_{next(Entity.__cursor_names)}'
+        started = cls.__instrumented() and time.perf_counter()
+        with cls.__statement(read=True, name=name, cursor_factory=None if related else DictCursor) as cursor:
+            try:
+                cursor.itersize = batch_size
+                cursor.execute(query, args)
+                if started:
+                    cls.__notify(query, len(args), started, -1)
+                bounds = None
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    if not related:
+                        yield from cls.__hydrate_rows(rows, deferred, annotations)
+                        continue
+
+                    if bounds is None:
+                        bounds = cls.__related_bounds(cursor.description, related)
+                    group = [] if deferred else None
+                    for row in rows:
+                        yield cls.__hydrate_related(row, bounds, group, annotations)
+            finally:
+                if not cursor.connection.closed:
+                    cursor.close()
+
+    @classmethod
+    @contextmanager
+    def __statement(cls, read=False, name=None, cursor_factory=DictCursor):
+        # handle exceptions together with transactions around a cursor
+        # reads outside a session run in autocommit, so they neither commit nor leave the connection
+        # idle in transaction, writes are committed here or by the session if there is one
+        # a transaction opened by the caller is left as it is
+        # a name creates a server-side cursor
+        session = Session.current()
+        db = cls.connection()
+        autocommit = read and session is None
+        if db.autocommit != autocommit and db.get_transaction_status() == TRANSACTION_STATUS_IDLE:
+            db.autocommit = autocommit
+        try:
+            if name is None:
+                yield db.cursor(cursor_factory=cursor_factory)
+            else:
+                yield db.cursor(name, cursor_factory=cursor_factory, withhold=True)
+            if not read and session is None:
+                db.commit()
         except Exception as e:
-            print(e)
-            self.db.rollback()
-            raise DatabaseError
+            if session is None:
+                db.rollback()
+            raise DatabaseError from e
+        # a session pins reads once it commits
+        if not read and session is None and Entity.replicas is not None:
+            Entity.replicas.pin()
+
+    @classmethod
+    def connection(cls):
+        # return a connection for the next statement: the one of the current session,
+        # a connection checked out from Entity.pool for the current thread or a shared cls.db
+        session = Session.current()
+        if session is not None:
+            return session.db
+
+        if Entity.pool is None:
+            if cls.db is None:
+                raise DatabaseError()
+            return cls.db
+
+        db = cls.thread_connection()
+        if db is None:
+            db = Entity.pool.getconn()
+            Entity.__local.checkout = _Checkout(db, Entity.pool)
+            # instances the thread already holds stay the same ones on its connection
+            key, Entity.__local.identity_key = getattr(Entity.__local, 'identity_key', None), None
+            with Entity.__identity_maps_lock:
+                if key in Entity.__identity_maps:
+                    Entity.__identity_maps[db] = Entity.__identity_maps.pop(key)
+        return db
+
+    @classmethod
+    def thread_connection(cls):
+        # return a connection already checked out from Entity.pool by the current thread or None
+        checkout = getattr(Entity.__local, 'checkout', None)
+        return None if checkout is None else checkout.db
+
+    @classmethod
+    def release_connection(cls):
+        # give a connection of the current thread back to Entity.pool, e.g. at the end of a request
+        # a thread ending without it gives its connection back when its thread-local data is dropped
+        checkout = getattr(Entity.__local, 'checkout', None)
+        if checkout is not None:
+            Entity.__local.checkout = None
+            checkout.release()
+
+    @classmethod
+    def identity_map(cls):
+        # return a map of (class, id) to the single instance of that row for the current connection,
+        # so a session shares it with everything running on its connection
+        # instances are held weakly and disappear once they are not used any more
+        key = cls.__identity_key()
+        with Entity.__identity_maps_lock:
+            if key not in Entity.__identity_maps:
+                Entity.__identity_maps[key] = weakref.WeakValueDictionary()
+            return Entity.__identity_maps[key]
+
+    @classmethod
+    def __identity_key(cls):
+        # the connection of the current session or thread, or cls.db without Entity.pool
+        # a thread of Entity.pool without a connection gets a key of its own, so reading from replicas
+        # doesn't check out and hold a primary connection only to find its identity map
+        session = Session.current()
+        if session is not None or Entity.pool is None:
+            return cls.connection()
+        db = cls.thread_connection()
+        if db is not None:
+            return db
+        key = getattr(Entity.__local, 'identity_key', None)
+        if key is None:
+            key = Entity.__local.identity_key = _ThreadKey()
+        return key
+
+    @classmethod
+    def clear_identity_map(cls, db=None):
+        # forget all instances of a connection, next accesses build and load them again
+        # it happens on rollback and when a connection goes back to the pool
+        if db is None:
+            db = cls.__identity_key()
+        with Entity.__identity_maps_lock:
+            Entity.__identity_maps.pop(db, None)
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        # run everything inside the block in one transaction
+        # nested blocks join the outer transaction
+        session = Session.current()
+        if session is not None:
+            yield session
+            return
+
+        with Session(cls.db) as session:
+            yield session
 
     def __insert(self):
         # generate an insert query string from fields keys and values and execute it
@@ -112,103 +824,176 @@ class Entity(object):
         columns = ", ".join(self.__fields.keys())
         placeholders = ", ".join(["%s" for _ in range(len(self.__fields.keys()))])
 
-        query = self.__insert_query.format(table=self.__table, columns=columns,
-                                           placeholders=placeholders)
+        query = self.__sql(self.__insert_query, table=self.__table, columns=columns,
+                           placeholders=placeholders)
 
-        self.__execute_query(query, tuple(self.__fields.values()))
-        self.__id = self.__cursor.fetchone()[0]
+        cursor = self.__execute_query(query, tuple(self.__fields.values()))
+        self.__id = cursor.fetchone()[0]
+        self.__changed = None
+        self.identity_map().setdefault((self.__class__, self.__id), self)
+        self.__invalidate(self.__table)
 
-    def __load(self):
+    def __load(self, name=None):
         # if current instance is not loaded yet — execute select statement and store it's result as an associative array
         # (fields), where column names used as keys
+        # deferred columns of the class are left out, unless name is one of them
         if not self.__loaded:
-            query = self.__select_query.format(table=self.__table)
-            self.__execute_query(query, (self.__id,))
-            data = self.__cursor.fetchone()
-            if not data:
+            deferred = self.__deferred_keys
+            if deferred and f'{self.__table}_{name}' in deferred:
+                deferred = ()
+            columns = self.__select_list(deferred)
+            query = self.__sql(self.__select_query, table=self.__table, columns=columns)
+            rows = self.__cached((self.__table, self.__id, None, columns), (self.__table,),
+                                 lambda: self.__execute_query(query, (self.__id,), read=True).fetchall())
+            if not rows:
                 raise NotFoundError
 
-            self.__fields.update(data)
+            self.__fields.update(rows[0])
             self.__loaded = True
 
+    @classmethod
+    def __load_many(cls, instances):
+        # like __load for every instance that is not loaded yet, but with one query for all of them
+        pending = [obj for obj in instances if not obj.__loaded]
+        if not pending:
+            return
+        query = cls.__sql(cls.__select_many_query, table=cls.__table,
+                          columns=cls.__select_list(cls.__deferred_keys))
+        cursor = cls.__execute(query, (list({obj.__id for obj in pending}),), read=True)
+        rows = {row[f'{cls.__table}_id']: row for row in cursor.fetchall()}
+
+        for obj in pending:
+            row = rows.get(obj.__id)
+            if row is None:
+                raise NotFoundError
+            obj.__fields.update(row)
+            obj.__loaded = True
+            if cls.__deferred_keys:
+                obj.__deferred = pending
+
     def __update(self):
-        # generate an update query string from fields keys and values and execute it
+        # generate an update query string from changed fields keys and values and execute it
         # use prepared statements
 
         columns = []
         args = []
-        for k, v in self.__fields.items():
+        for k in sorted(self.__changed):
             columns.append(f"{k}=%s")
-            args.append(v)
+            args.append(self.__fields[k])
 
         columns = ", ".join(columns)
         args.append(self.__id)
 
-        query = self.__update_query.format(table=self.__table, columns=columns)
-        self.__execute_query(query, tuple(args))
+        version = self.__version()
+        if version is None:
+            query = self.__sql(self.__update_query, table=self.__table, columns=columns)
+            self.__execute_query(query, tuple(args))
+        else:
+            # the trigger sets a new version, it comes back with RETURNING, so the instance isn't reloaded
+            query = self.__sql(self.__versioned_update_query, table=self.__table, columns=columns)
+            row = self.__execute_query(query, tuple(args) + (version,)).fetchone()
+            if row is None:
+                raise ConflictError(f'{self.__class__.__name__} {self.__id} was changed since it was loaded')
+            self.__fields[f'{self.__table}_updated'] = row[0]
+        self.__changed = None
+        self.__invalidate(self.__table)
+
+    def __version(self):
+        # return the loaded <table>_updated to check with optimistic locking or None
+        if not self.optimistic_locking or not self.__loaded:
+            return None
+        return self.__fields.get(f'{self.__table}_updated')
 
     def __update_chldr(self):
-        # __update_children = 'UPDATE "{table}" SET {parent}_id=%s WHERE {table}_id IN ({children})'
+        # __update_children = 'UPDATE "{table}" SET {parent}_id=%s WHERE {table}_id = ANY(%s)'
         for child, ids in self.__children.items():
-            query = self.__update_children.format(table=child, parent=self.__table,
-                                                  children=", ".join([str(x) for x in ids]))
-            self.__execute_query(query, (self.__id,))
+            query = self.__sql(self.__update_children, table=child, parent=self.__table)
+            self.__execute_query(query, (self.__id, list(ids)))
+            self.__invalidate(child)
 
     def __insert_sbl(self):
-        # __insert_sibling_query = 'INSERT INTO "{table}" ({columns}) VALUES {multiple_placeholders}'
-
+        # make the pivot table hold exactly the assigned siblings with one statement per pivot table:
+        # links which are not assigned any more are deleted, new ones are inserted and existing ones are kept
         for assigned_table, val in self.__siblings.items():
-            col = [f'{self.__table}_id', f'{assigned_table}_id']
-            columns = ", ".join(col)
-            placeholders = ", ".join(["%s" for _ in range(len(col))])
-
-            multiple_rows = ", ".join('({placeholders})' for _ in range(len(val))).format(placeholders=placeholders)
-            pivot_name = '__'.join(sorted([assigned_table, self.__table]))
+            pivot_name = self.__pivot_name(assigned_table, self.__table)
+            query = self.__sql(self.__sync_sibling_query, table=pivot_name,
+                               owner=self.__table, sibling=assigned_table)
+            ids = list(set(val))
 
-            query = self.__insert_sibling_query.format(table=pivot_name,
-                                                       columns=columns,
-                                                       multiple_placeholders=multiple_rows)
-            list_ids = []
-            for upd_id in val:
-                list_ids.append(self.__id)
-                list_ids.append(upd_id)
-
-            self.__execute_query(query, tuple(list_ids,))
+            self.__execute_query(query, (self.__id, ids, self.__id, ids))
+        self.__siblings = None
 
     def _get_children(self, name):
         # return an array of child entity instances
         # each child instance must have an id and be filled with data
         # __parent_query = 'SELECT * FROM "{table}" WHERE {parent}_id=%s'
 
-        array_instances = []
-        mod = __import__('models')
-        my_cls = getattr(mod, self._children[name])
+        if self.__prefetched and name in self.__prefetched:
+            if not self.__prefetched[name]:
+                raise NotFoundError
+            return self.__prefetched[name]
+
+        my_cls = self.__entity_class(self._children[name])
         children_table = self._children[name].lower()
 
-        query = self.__parent_query.format(table=children_table, parent=self.__table)
-        self.__execute_query(query, (self.__id,))
-        list_data = self.__cursor.fetchall()
+        columns = my_cls.__select_list(my_cls.__deferred_keys)
+        query = self.__sql(self.__parent_query, table=children_table, parent=self.__table, columns=columns)
+        list_data = self.__cached((self.__table, self.__id, name, columns), (children_table,),
+                                  lambda: self.__execute_query(query, (self.__id,), read=True).fetchall())
 
         if not list_data:
             raise NotFoundError
-        for data in list_data:
-            row_id = data[f'{children_table}_id']
-            my_instance = my_cls(row_id)
-            array_instances.append(my_instance)
 
-        return array_instances
+        return my_cls.__hydrate_rows(list_data, my_cls.__deferred_keys)
 
     def _get_column(self, name):
         # return value from fields array by <table>_<name> as a key
-        return self.__fields[f'{self.__table}_{name}']
+        return self.__field(f'{self.__table}_{name}')
+
+    def __field(self, key):
+        # return a value from fields, a deferred column is fetched first together with the rest of its result set
+        # a missing one raises AttributeError, so hasattr and getattr with a default keep working
+        try:
+            return self.__fields[key]
+        except KeyError:
+            self.__load_deferred()
+        try:
+            return self.__fields[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __load_deferred(self):
+        # fetch columns missing from fields with one query for every instance loaded by the same select,
+        # so touching a deferred column of one instance in a list doesn't cost a query per instance
+        if self.__id is None:
+            return
+        missing = [key for key in self.__column_types() if key not in self.__fields]
+        if not missing:
+            return
+
+        group = self.__deferred or [self]
+        query = self.__sql(self.__deferred_query, table=self.__table,
+                           columns=", ".join(f'"{key}"' for key in missing))
+        cursor = self.__execute(query, (list({obj.__id for obj in group}),), read=True)
+        loaded = {row[0]: row for row in cursor.fetchall()}
+
+        for obj in group:
+            row = loaded.get(obj.__id)
+            if row is not None:
+                for key in missing:
+                    obj.__fields.setdefault(key, row[key])
+            obj.__deferred = None
 
     def _get_parent(self, name):
         # ORM part 2
         # get parent id from fields with <name>_id as a key
         # return an instance of parent entity class with an appropriate id
-        mod = __import__('models')
-        my_cls = getattr(mod, name.capitalize())
-        my_instance = my_cls(self.__fields[f'{name}_id'])
+        if self.__prefetched and name in self.__prefetched:
+            return self.__prefetched[name]
+
+        my_cls = self.__entity_class(name.capitalize())
+        my_instance = my_cls.__identity(self.__field(f'{name}_id'))
+        self.__remember(name, my_instance)
 
         return my_instance
 
@@ -219,28 +1004,44 @@ class Entity(object):
         # each sibling instance must have an id and be filled with data
         # __sibling_query = 'SELECT * FROM "{sibling}" NATURAL JOIN "{join_table}" WHERE {table}_id=%s'
 
-        array_instances = []
-        mod = __import__('models')
-        my_cls = getattr(mod, self._siblings[name])
+        if self.__prefetched and name in self.__prefetched:
+            if not self.__prefetched[name]:
+                raise NotFoundError
+            return self.__prefetched[name]
+
+        my_cls = self.__entity_class(self._siblings[name])
         sibling_table = self._siblings[name].lower()
 
-        query = self.__sibling_query.format(sibling=sibling_table,
-                                            join_table=f'{self.__table}__{sibling_table}',
-                                            table=self.__table)
+        columns = '*'
+        if my_cls.__deferred_keys:
+            columns = my_cls.__select_list(my_cls.__deferred_keys, qualified=True)
+        query = self.__sql(self.__sibling_query, sibling=sibling_table,
+                           join_table=self.__pivot_name(self.__table, sibling_table),
+                           table=self.__table, columns=columns)
 
-        self.__execute_query(query, (self.__id,))
-        list_data = self.__cursor.fetchall()
+        cursor = self.__execute_query(query, (self.__id,), read=True)
+        list_data = cursor.fetchall()
 
         if not list_data:
             raise NotFoundError
-        for data in list_data:
-            row_id = data[f'{sibling_table}_id']
-            my_instance = my_cls(row_id)
-            my_instance.__fields = data
-            my_instance.__loaded = True
-            array_instances.append(my_instance)
 
-        return array_instances
+        return my_cls.__hydrate_rows(list_data, my_cls.__deferred_keys)
+
+    def related_rows(self, name):
+        # return children or siblings as read-only Row tuples, they are not kept by the instance
+        kind = self.__kinds.get(name)
+        if kind == 'children':
+            my_cls = self.__entity_class(self._children[name])
+            query = self.__sql(self.__parent_query, table=my_cls.__table, parent=self.__table, columns='*')
+        elif kind == 'siblings':
+            my_cls = self.__entity_class(self._siblings[name])
+            query = self.__sql(self.__sibling_query, sibling=my_cls.__table,
+                               join_table=self.__pivot_name(self.__table, my_cls.__table),
+                               table=self.__table, columns='*')
+        else:
+            raise AttributeError(name)
+
+        return my_cls._fetch_rows(query, (self.__id,))
 
     def _set_siblings(self, name, value):
 
@@ -248,17 +1049,36 @@ class Entity(object):
         sbl = []
         for v_id in value:
             sbl.append(v_id.id)
+        if self.__siblings is None:
+            self.__siblings = {}
         self.__siblings[sibling_table] = sbl
+        if self.__prefetched:
+            self.__prefetched.pop(name, None)
 
     def _set_column(self, name, value):
         # put new value into fields array with <table>_<name> as a key
         self.__fields[f'{self.__table}_{name}'] = value
+        self.__change(f'{self.__table}_{name}')
 
     def _set_parent(self, name, value):
         # ORM part 2
         # put new value into fields array with <name>_id as a key
         # value can be a number or an instance of Entity subclass
         self.__fields[f'{name}_id'] = value.id
+        self.__change(f'{name}_id')
+        self.__remember(name, value)
+
+    def __change(self, key):
+        # remember a changed key of fields, the set is created on first change
+        if self.__changed is None:
+            self.__changed = set()
+        self.__changed.add(key)
+
+    def __remember(self, name, value):
+        # keep a resolved relation, the dict is created on first use
+        if self.__prefetched is None:
+            self.__prefetched = {}
+        self.__prefetched[name] = value
 
     def _set_children(self, name, value):
         # __update_children = 'UPDATE "{table}" SET {parent}_id=%s WHERE {table}_id IN ({children})'
@@ -266,17 +1086,22 @@ class Entity(object):
         for cat_id in value:
             chl.append(cat_id.id)
         child_table = self._children[name].lower()
+        if self.__children is None:
+            self.__children = {}
         self.__children[child_table] = chl
 
     @classmethod
-    def all(cls):
+    def all(cls, rows=False):
         # get ALL rows with ALL columns from corresponding table
         # for each row create an instance of appropriate class
         # each instance must be filled with column data, a correct id and MUST NOT query a database for own fields any more
-        # return an array of instances
-        table_name = cls.__name__.lower()
+        # return an array of instances, or of read-only Row tuples if rows is true
+        table_name = cls.__table
         data = []
 
+        if rows:
+            return cls._fetch_rows(cls.__sql(cls.__list_query, table=table_name, columns='*'), ())
+
         # cursor = cls.db.cursor(
         #     cursor_factory=psycopg2.extras.DictCursor
         # )
@@ -289,24 +1114,537 @@ class Entity(object):
         #     cls.db.rollback()
         #     raise DatabaseError
 
-        tmp_obj = cls()
-        tmp_obj.__execute_query(cls.__list_query.format(table=table_name), tuple())
-        res = tmp_obj.__cursor.fetchall()
+        columns = cls.__select_list(cls.__deferred_keys)
+        query = cls.__sql(cls.__list_query, table=table_name, columns=columns)
+        res = cls.__cached((table_name, None, 'all', columns), (table_name,),
+                           lambda: cls.__execute(query, tuple(), read=True).fetchall())
 
-        for el in res:
-            obj = cls()
-            obj.__fields = el
-            obj.__id = el.get(f"{table_name}_id")
-            obj.__loaded = True
-            data.append(obj)
+        data.extend(cls.__hydrate_rows(res, cls.__deferred_keys))
         return data
 
-    def delete(self):
+    @classmethod
+    def iter_all(cls, batch_size=1000):
+        # like all(), but instances are yielded while rows are streamed from a server-side cursor
+        return cls.query().iterator(batch_size)
+
+    @classmethod
+    def query(cls):
+        # return a lazy query over the table, nothing is executed until it is iterated
+        return Query(cls)
+
+    @classmethod
+    def annotate(cls, instances, **aggregates):
+        # compute aggregates of relations for a whole list of instances, one GROUP BY query per relation:
+        #     Entity.annotate(categories, post_count=Count('posts'))
+        #     categories[0].post_count
+        # return the same list of instances
+        instances = [obj for obj in instances if obj.__id is not None]
+        if not instances:
+            return instances
+
+        model = type(instances[0])
+        ids = list({obj.__id for obj in instances})
+        for name, source, owner, selected in model._aggregate_relations(aggregates):
+            query = model.__sql(model.__annotate_query, owner=owner, source=source,
+                                aggregates=", ".join(f'{sql} AS "{alias}"' for alias, sql, _ in selected))
+            cursor = model.__execute(query, (ids,), read=True)
+            loaded = {row['owner_id']: row for row in cursor.fetchall()}
+
+            for obj in instances:
+                row = loaded.get(obj.__id)
+                obj.__annotate((alias, default if row is None else row[alias]) for alias, _, default in selected)
+
+        return instances
+
+    @classmethod
+    def _aggregate_relations(cls, aggregates):
+        # resolve aggregates through _children and _siblings, a relation is aggregated once for all of its aggregates
+        # return (relation name, from clause, owner id column, [(alias, aggregate sql, default)]) per relation
+        paths = {}
+        for alias, aggregate in aggregates.items():
+            if alias in cls.__kinds or alias in ('id', 'created', 'updated'):
+                raise AttributeError(alias)
+            name, _, column = aggregate.path.partition('__')
+            paths.setdefault(name, []).append((alias, aggregate, column))
+
+        relations = []
+        for name, items in paths.items():
+            source, owner, my_cls, counted = cls.__aggregate_source(name, any(column for _, _, column in items))
+            selected = []
+            for alias, aggregate, column in items:
+                if column:
+                    expression = my_cls._column_sql(column)
+                elif aggregate.function == 'count':
+                    expression = counted
+                else:
+                    raise AttributeError(aggregate.path)
+                selected.append((alias, aggregate.sql(expression), aggregate.default))
+            relations.append((name, source, owner, selected))
+        return relations
+
+    @classmethod
+    def __aggregate_source(cls, name, joined):
+        # return a from clause, an owner id column, a related class and a column to count of a relation
+        # counting siblings only needs the pivot table, the sibling table is joined if a column of it is aggregated
+        kind = cls.__kinds.get(name)
+        if kind == 'children':
+            my_cls = cls.__entity_class(cls._children[name])
+            related_table = my_cls.__table
+            return f'"{related_table}"', f'"{related_table}".{cls.__table}_id', my_cls, \
+                f'"{related_table}".{related_table}_id'
+        elif kind == 'siblings':
+            my_cls = cls.__entity_class(cls._siblings[name])
+            related_table = my_cls.__table
+            pivot = cls.__pivot_name(cls.__table, related_table)
+            source = f'"{pivot}"'
+            if joined:
+                source += f' JOIN "{related_table}" ' \
+                          f'ON "{related_table}".{related_table}_id = "{pivot}".{related_table}_id'
+            return source, f'"{pivot}".{cls.__table}_id', my_cls, f'"{pivot}".{related_table}_id'
+        raise AttributeError(name)
+
+    @classmethod
+    def _column_sql(cls, name):
+        # return a qualified column for a column, a parent, id, created or updated
+        if name in ('id', 'created', 'updated') or cls.__kinds.get(name) == 'column':
+            return f'"{cls.__table}".{cls.__table}_{name}'
+        elif cls.__kinds.get(name) == 'parent':
+            return f'"{cls.__table}".{name}_id'
+        raise AttributeError(name)
+
+    @classmethod
+    def prefetch(cls, instances, *names):
+        # load relations for a whole list of instances, one query per relation
+        # names are parents, children or siblings of cls; 'posts__comments' walks into the loaded children
+        # every instance gets its relation stored, so later attribute access doesn't query a database
+        # return the same list of instances
+        instances = [obj for obj in instances if obj.__id is not None]
+        if not instances:
+            return instances
+
+        model = type(instances[0])
+        for path in names:
+            name, _, rest = path.partition('__')
+            related = model.__prefetch_one(instances, name)
+            if rest and related:
+                model.prefetch(related, rest)
+
+        return instances
+
+    @classmethod
+    def __prefetch_one(cls, instances, name):
+        # run a single '= ANY(%s)' query for relation name and spread its rows over instances
+        # return a flat list of all loaded related instances
+        table_name = cls.__table
+        ids = list({obj.__id for obj in instances})
+        kind = cls.__kinds.get(name)
+
+        if kind == 'parent':
+            my_cls = cls.__entity_class(name.capitalize())
+            cls.__load_many(instances)
+            parent_ids = list({obj.__field(f'{name}_id') for obj in instances})
+            query = cls.__sql(cls.__prefetch_parent_query, table=name,
+                              columns=my_cls.__select_list(my_cls.__deferred_keys))
+            cursor = cls.__execute(query, (parent_ids,), read=True)
+
+            parents = my_cls.__hydrate_rows(cursor.fetchall(), my_cls.__deferred_keys)
+            loaded = {parent.__id: parent for parent in parents}
+            for obj in instances:
+                if obj.__fields[f'{name}_id'] in loaded:
+                    obj.__remember(name, loaded[obj.__fields[f'{name}_id']])
+            return list(loaded.values())
+
+        if kind == 'children':
+            my_cls = cls.__entity_class(cls._children[name])
+            related_table = cls._children[name].lower()
+            query = cls.__sql(cls.__prefetch_children_query, table=related_table, parent=table_name,
+                              columns=my_cls.__select_list(my_cls.__deferred_keys))
+        elif kind == 'siblings':
+            my_cls = cls.__entity_class(cls._siblings[name])
+            related_table = cls._siblings[name].lower()
+            join_table = cls.__pivot_name(table_name, related_table)
+            columns = '*'
+            if my_cls.__deferred_keys:
+                columns = f'{my_cls.__select_list(my_cls.__deferred_keys, qualified=True)}, ' \
+                          f'"{join_table}".{table_name}_id'
+            query = cls.__sql(cls.__prefetch_sibling_query, sibling=related_table, join_table=join_table,
+                              table=table_name, columns=columns)
+        else:
+            raise AttributeError
+
+        cursor = cls.__execute(query, (ids,), read=True)
+        rows = cursor.fetchall()
+        grouped = {row_id: [] for row_id in ids}
+        related = my_cls.__hydrate_rows(rows, my_cls.__deferred_keys)
+        for row, my_instance in zip(rows, related):
+            grouped[row[f'{table_name}_id']].append(my_instance)
+
+        for obj in instances:
+            obj.__remember(name, grouped[obj.__id])
+        return related
+
+    @classmethod
+    def bulk_create(cls, objs, batch_size=1000):
+        # insert many new instances with multi-row INSERT statements of up to batch_size rows
+        # ids and default columns come back from RETURNING, so instances are not reloaded
+        # assigned children and siblings are saved in the same transaction
+        # return the same list of instances
+        # instances assigning the same columns in any order share one statement
+        # an instance without fields has no row to insert, so its children and siblings couldn't be saved
+        table_name = cls.__table
+        groups = {}
+        for obj in objs:
+            if obj.__id or not obj.__fields:
+                raise RuntimeException
+            groups.setdefault(tuple(sorted(obj.__fields)), []).append(obj)
+
+        with cls.transaction() as session:
+            identity_map = cls.identity_map()
+            for keys, group in groups.items():
+                query = cls.__sql(cls.__bulk_insert_query, table=table_name, columns=", ".join(keys))
+                rows = [tuple(obj.__fields[k] for k in keys) for obj in group]
+
+                for obj, row in zip(group, cls.__execute_values(query, rows, page_size=batch_size)):
+                    obj.__fields = row
+                    obj.__id = row[f'{table_name}_id']
+                    obj.__loaded = True
+                    obj.__modified = False
+                    obj.__changed = None
+                    identity_map.setdefault((cls, obj.__id), obj)
+            cls.__invalidate(table_name)
+
+            for obj in objs:
+                session.discard(obj)
+                if obj.__children:
+                    obj.__update_chldr()
+                if obj.__siblings:
+                    obj.__insert_sbl()
+        return objs
+
+    @classmethod
+    def bulk_update(cls, objs, fields, batch_size=1000):
+        # write given columns or parents of many saved instances with one UPDATE ... FROM (VALUES ...) per batch
+        # new <table>_updated values come back from RETURNING
+        # with optimistic locking nothing is written if any loaded instance has an outdated version
+        # return the same list of instances
+        if not objs:
+            return objs
+
+        table_name = cls.__table
+        keys = [cls.__field_key(name) for name in fields]
+        names = [f'{table_name}_id'] + keys
+        types = cls.__column_types()
+        template = [f'%s::{types[k]}' for k in names]
+
+        if cls.optimistic_locking:
+            query = cls.__versioned_bulk_update_query
+            template.append('%s::integer')
+        else:
+            query = cls.__bulk_update_query
+        query = cls.__sql(query, table=table_name, columns=", ".join(f'{k}=data.{k}' for k in keys),
+                          names=", ".join(names))
+        template = '({})'.format(", ".join(template))
+
+        rows = []
+        by_id = {}
+        for obj in objs:
+            if not obj.__id or any(k not in obj.__fields for k in keys):
+                raise RuntimeException
+            row = [obj.__id] + [obj.__fields[k] for k in keys]
+            if cls.optimistic_locking:
+                row.append(obj.__version())
+            rows.append(tuple(row))
+            by_id.setdefault(obj.__id, []).append(obj)
+
+        with cls.transaction() as session:
+            updated = cls.__execute_values(query, rows, template, page_size=batch_size)
+            if len(updated) < len(by_id):
+                conflicts = set(by_id).difference(row[0] for row in updated)
+                raise ConflictError(f'{cls.__name__} {sorted(conflicts)} were changed since they were loaded')
+
+            for row in updated:
+                for obj in by_id[row[0]]:
+                    obj.__fields[f'{table_name}_updated'] = row[1]
+                    obj.__modified = False
+                    if obj.__changed:
+                        obj.__changed.difference_update(keys)
+                    session.discard(obj)
+            cls.__invalidate(table_name)
+        return objs
+
+    @classmethod
+    def __cached(cls, key, tables, fetch):
+        # read rows through Entity.cache if it is set,
+        # key is (table, id, relation, selected columns) and tables are the ones rows come from
+        # cached rows are copied, so instances filled with them can change their fields
+        # a session reads past the cache, its rows may be uncommitted and must not be seen by other threads
+        if Entity.cache is None or Session.current() is not None:
+            return fetch()
+        rows = Entity.cache.fetch(key, tables, lambda: [dict(row) for row in fetch()])
+        return [dict(row) for row in rows]
+
+    @classmethod
+    def __invalidate(cls, *tables):
+        # drop values read from written tables from Entity.cache, a session drops them once more when it ends
+        if Entity.cache is None:
+            return
+        for table in tables:
+            Entity.cache.invalidate(table)
+        session = Session.current()
+        if session is not None:
+            session.written(tables)
+
+    @classmethod
+    def export(cls, fileobj, format='csv', columns=None, relation=None):
+        # stream the table into fileobj with COPY, no instances are created
+        # columns are names of columns and parents, by default id, all columns, parents, created and updated;
+        # relation is a name of siblings to export their pivot table instead
+        # csv starts with a header row, binary needs a file opened in binary mode
+        # return a number of copied rows
+        table, keys = cls.__copy_columns(columns, relation)
+        query = cls.__sql(cls.__copy_out_query, table=table, columns=", ".join(keys),
+                          format=cls.__copy_format(format), header=', HEADER' if format == 'csv' else '')
+        return cls.__copy(query, fileobj, read=True)
+
+    @classmethod
+    def import_(cls, fileobj, format='csv', columns=None, relation=None):
+        # load rows written by export from fileobj with COPY, arguments are the same as for export
+        # when ids are imported, the id sequence continues after the largest one
+        # return a number of copied rows
+        table, keys = cls.__copy_columns(columns, relation)
+        query = cls.__sql(cls.__copy_in_query, table=table, columns=", ".join(keys),
+                          format=cls.__copy_format(format), header=', HEADER' if format == 'csv' else '')
+
+        with cls.transaction():
+            count = cls.__copy(query, fileobj)
+            if f'{table}_id' in keys:
+                cls.__execute(cls.__sql(cls.__sequence_query, table=table), ())
+            cls.__invalidate(table)
+        return count
+
+    @classmethod
+    def __copy_columns(cls, columns, relation):
+        # return a table and its column names for COPY
+        if relation is not None:
+            if cls.__kinds.get(relation) != 'siblings':
+                raise AttributeError(relation)
+            sibling_table = cls._siblings[relation].lower()
+            return cls.__pivot_name(cls.__table, sibling_table), [f'{cls.__table}_id', f'{sibling_table}_id']
+
+        if columns is None:
+            columns = ['id'] + list(cls._columns) + list(cls._parents) + ['created', 'updated']
+        keys = [f'{cls.__table}_{name}' if name in ('id', 'created', 'updated') else cls.__field_key(name)
+                for name in columns]
+        return cls.__table, keys
+
+    @staticmethod
+    def __copy_format(format):
+        if format not in ('csv', 'binary'):
+            raise ValueError(f'unknown copy format: {format}')
+        return format
+
+    @classmethod
+    def __copy(cls, query, fileobj, read=False):
+        # run COPY TO STDOUT or FROM STDIN, psycopg2 streams fileobj in chunks
+        started = cls.__instrumented() and time.perf_counter()
+        with cls.__statement(read) as cursor:
+            cursor.copy_expert(query, fileobj)
+        if started:
+            cls.__notify(query, 0, started, cursor.rowcount)
+        return cursor.rowcount
+
+    @classmethod
+    def __field_key(cls, name):
+        # return a key in fields for a column or a parent name
+        kind = cls.__kinds.get(name)
+        if kind == 'column':
+            return f'{cls.__table}_{name}'
+        elif kind == 'parent':
+            return f'{name}_id'
+        raise AttributeError
+
+    @classmethod
+    def __column_types(cls):
+        # return sql types of table columns, they are read from pg_attribute once per table
+        table_name = cls.__table
+        if table_name not in Entity.__types:
+            cursor = cls.__execute(cls.__column_types_query, (f'"{table_name}"',), read=True)
+            Entity.__types[table_name] = dict(cursor.fetchall())
+        return Entity.__types[table_name]
+
+    @classmethod
+    def __hydrate(cls, row, group=None, annotations=()):
+        # return an instance filled with an already fetched row, so it MUST NOT query a database for own fields
+        # an instance already known to the identity map is reused, loaded or modified ones are kept as they are
+        # group is a list of instances of a result set with deferred columns, they are fetched for all of them
+        # annotations are always taken from the row
+        obj = cls.__identity(row.get(f"{cls.__table}_id"))
+        if not obj.__loaded and not obj.__modified:
+            if group is None:
+                obj.__fields = row
+            else:
+                obj.__fields = dict(row)
+                obj.__deferred = group
+                group.append(obj)
+            obj.__loaded = True
+        if annotations:
+            obj.__annotate(((name, row[name]) for name in annotations))
+        return obj
+
+    @classmethod
+    def __hydrate_rows(cls, rows, deferred=(), annotations=()):
+        if not deferred:
+            return [cls.__hydrate(row, None, annotations) for row in rows]
+        group = []
+        return [cls.__hydrate(row, group, annotations) for row in rows]
+
+    def __annotate(self, values):
+        if self.__annotations is None:
+            self.__annotations = {}
+        self.__annotations.update(values)
+
+    @classmethod
+    def __select_list(cls, deferred=(), qualified=False):
+        # return columns to select, all of them but deferred ones
+        prefix = f'"{cls.__table}".' if qualified else ''
+        if not deferred:
+            return f'{prefix}*'
+        return ", ".join(f'{prefix}"{key}"' for key in cls.__column_types() if key not in deferred)
+
+    @classmethod
+    def _select_columns(cls, only=None, defer=(), qualified=False, undeferred=False):
+        # return columns to select and keys of deferred ones for Query.only and Query.defer
+        # only keeps id and given columns or parents, defer adds to _deferred of the class,
+        # undeferred selects every column regardless of _deferred
+        if undeferred:
+            deferred = ()
+        elif only is None and not defer:
+            deferred = cls.__deferred_keys
+        else:
+            keys = cls.__column_types()
+            if only is None:
+                deferred = set(cls.__deferred_keys)
+            else:
+                kept = {f'{cls.__table}_id'}.union(cls.__field_key(name) for name in only)
+                if cls.optimistic_locking:
+                    kept.add(f'{cls.__table}_updated')
+                deferred = {key for key in keys if key not in kept}
+            deferred.update(cls.__field_key(name) for name in defer)
+            deferred.discard(f'{cls.__table}_id')
+            deferred = tuple(key for key in keys if key in deferred)
+        return cls.__select_list(deferred, qualified), deferred
+
+    @classmethod
+    def __related_bounds(cls, description, related):
+        # find where columns of every joined parent start and end,
+        # parts of a joined row are separated by NULL AS "__<parent>" marker columns
+        columns = [column.name for column in description]
+        markers = [columns.index(f'__{name}') for name in related] + [len(columns)]
+
+        bounds = [(None, columns[:markers[0]], 0, markers[0])]
+        for i, name in enumerate(related):
+            start, end = markers[i] + 1, markers[i + 1]
+            bounds.append((name, columns[start:end], start, end))
+        return bounds
+
+    @classmethod
+    def __hydrate_related(cls, row, bounds, group=None, annotations=()):
+        # split a joined row into an instance and its already loaded parents
+        _, columns, start, end = bounds[0]
+        obj = cls.__hydrate(dict(zip(columns, row[start:end])), group, annotations)
+
+        for name, columns, start, end in bounds[1:]:
+            parent_row = dict(zip(columns, row[start:end]))
+            if parent_row.get(f'{name}_id') is not None:
+                parent = cls.__entity_class(name.capitalize()).__hydrate(parent_row)
+                obj.__remember(name, parent)
+        return obj
+
+    @classmethod
+    def __identity(cls, id):
+        # return the instance with id from the identity map or a new not loaded one
+        identity_map = cls.identity_map()
+        obj = identity_map.get((cls, id))
+        if obj is None:
+            obj = cls(id)
+            identity_map[(cls, id)] = obj
+        return obj
+
+    @staticmethod
+    def __pivot_name(first_table, second_table):
+        # pivot tables are named after both tables in alphabetical order, e.g. post__tag
+        return '__'.join(sorted([first_table, second_table]))
+
+    def delete(self, cascade=False):
         # execute delete query with appropriate id
+        # cascade deletes children and pivot rows of siblings first, everything in one transaction
         if not self.__id:
             raise RuntimeException
-        query = self.__delete_query.format(table=self.__table)
-        self.__execute_query(query, (self.__id,))
+
+        with self.transaction() if cascade else nullcontext():
+            tables = self.__delete_dependents((self.__id,)) if cascade else []
+            version = self.__version()
+            if version is None:
+                query = self.__sql(self.__delete_query, table=self.__table)
+                self.__execute_query(query, (self.__id,))
+            else:
+                query = self.__sql(self.__versioned_delete_query, table=self.__table)
+                if not self.__execute_query(query, (self.__id, version)).rowcount:
+                    raise ConflictError(f'{self.__class__.__name__} {self.__id} was changed since it was loaded')
+        self.__forget_deleted({self.__id}, tables)
+        self.__invalidate(self.__table, *tables)
+
+    @classmethod
+    def _delete_selected(cls, query, args, cascade=False):
+        # delete rows whose ids are the first column of a select statement, return a number of deleted rows
+        # ids are selected once, so every statement deletes the same set even if rows change meanwhile
+        with cls.transaction():
+            ids = [row[0] for row in cls.__execute(query, args, read=True).fetchall()]
+            if not ids:
+                return 0
+            tables = cls.__delete_dependents(ids) if cascade else []
+            count = cls.__execute(cls.__sql(cls.__delete_many_query, table=cls.__table), (ids,)).rowcount
+
+        cls.__forget_deleted(set(ids), tables)
+        cls.__invalidate(cls.__table, *tables)
+        return count
+
+    @classmethod
+    def __forget_deleted(cls, ids, tables):
+        # drop deleted rows from the identity map, so they are loaded again and raise NotFoundError:
+        # ids of cls and every instance of a table deleted by a cascade, whose ids are never fetched
+        identity_map = cls.identity_map()
+        for key in list(identity_map.keys()):
+            if key[0] is cls and key[1] in ids or key[0].__table in tables:
+                identity_map.pop(key, None)
+
+    @classmethod
+    def __delete_dependents(cls, ids):
+        # delete rows referencing ids through _children, deepest first, and pivot rows of _siblings,
+        # one statement per table and path; return the deleted tables
+        # deeper tables are matched with subqueries on their parents, so only ids of cls are sent
+        tables = []
+        for table, query in cls.__cascade('= ANY(%s)', (cls,)):
+            cls.__execute(query, (list(ids),))
+            tables.append(table)
+        return tables
+
+    @classmethod
+    def __cascade(cls, match, path):
+        # yield (table, delete statement) for rows depending on cls rows with an id matching match
+        table_name = cls.__table
+        for name in getattr(cls, '_siblings', {}):
+            pivot = cls.__pivot_name(table_name, cls._siblings[name].lower())
+            yield pivot, cls.__sql(cls.__cascade_delete_query, table=pivot, owner=table_name, match=match)
+
+        for name in getattr(cls, '_children', {}):
+            my_cls = cls.__entity_class(cls._children[name])
+            if my_cls in path:
+                continue
+            child_match = cls.__sql(cls.__cascade_match, table=my_cls.__table, owner=table_name, match=match)
+            yield from my_cls.__cascade(child_match, path + (my_cls,))
+            yield my_cls.__table, cls.__sql(cls.__cascade_delete_query, table=my_cls.__table, owner=table_name,
+                                            match=match)
 
     @property
     def id(self):
@@ -316,22 +1654,336 @@ class Entity(object):
     @property
     def created(self):
         # try to guess yourself
-        return self.__fields[f'{self.__table}_created']
+        return self.__field(f'{self.__table}_created')
 
     @property
     def updated(self):
         # try to guess yourself
-        return self.__fields[f'{self.__table}_updated']
+        return self.__field(f'{self.__table}_updated')
 
     def save(self):
         # execute either insert or update query, depending on instance id
-        if self.__fields:
-            if not self.__id:
-                self.__insert()
-                self.__load()
+        # an update writes only changed fields and nothing is executed if there are none
+        # all statements of one save are committed together
+        if not self.__changed and not self.__children and not self.__siblings:
+            session = Session.current()
+            if session is not None:
+                session.discard(self)
+            return
+
+        with self.transaction() as session:
+            session.discard(self)
+            if self.__changed:
+                if not self.__id:
+                    self.__insert()
+                    self.__load()
+                else:
+                    self.__update()
+            if self.__children:
+                self.__update_chldr()
+            if self.__siblings:
+                self.__insert_sbl()
+
+
+class Aggregate(object):
+    # sql aggregate for Query.annotate, Query.aggregate and Entity.annotate, e.g.
+    #     Count('posts'), Max('posts__created'), Sum('comments__post', distinct=True)
+    # for annotations a path starts with a child or a sibling name followed by an optional __<column>,
+    # Query.aggregate takes columns of the queried table or its annotations
+    function = None
+    # value of a relation without rows
+    default = None
+
+    def __init__(self, path, distinct=False):
+        self.path = path
+        self.distinct = distinct
+
+    def sql(self, expression):
+        return f'{self.function}({"DISTINCT " if self.distinct else ""}{expression})'
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path!r})'
+
+
+class Count(Aggregate):
+    function = 'count'
+    default = 0
+
+
+class Sum(Aggregate):
+    function = 'sum'
+
+
+class Avg(Aggregate):
+    function = 'avg'
+
+
+class Min(Aggregate):
+    function = 'min'
+
+
+class Max(Aggregate):
+    function = 'max'
+
+
+class Query(object):
+    # lazy, chainable select of entity instances, compiled into one parameterized statement
+    # every chained call returns a new query, nothing is executed until the query is iterated
+    # or all(), first(), count() or exists() is called
+    # iterating a query streams rows from a server-side cursor, so memory stays flat for any table size
+    __select_query = 'SELECT {columns} FROM "{table}"{joins}{where}{order}{limit}'
+    __related_columns = ', NULL AS "__{parent}", "{parent}".*'
+    __related_join = ' LEFT JOIN "{parent}" ON "{parent}".{parent}_id = "{table}".{parent}_id'
+    __annotate_columns = ', {value} AS "{name}"'
+    __annotate_join = ' LEFT JOIN (SELECT {owner} AS owner_id, {aggregates} FROM {source} GROUP BY {owner}) ' \
+                      'AS "{alias}" ON "{alias}".owner_id = "{table}".{table}_id'
+    __count_query = 'SELECT count(*) FROM ({query}) AS counted'
+    __exists_query = 'SELECT EXISTS ({query})'
+    __aggregate_query = 'SELECT {aggregates} FROM ({query}) AS "{table}"'
+
+    __operators = {
+        'exact': '=',
+        'ne': '<>',
+        'lt': '<',
+        'lte': '<=',
+        'gt': '>',
+        'gte': '>=',
+        'like': 'LIKE',
+        'ilike': 'ILIKE',
+    }
+
+    def __init__(self, entity_class):
+        self.__entity_class = entity_class
+        self.__table = entity_class.__name__.lower()
+        self.__where = []
+        self.__args = []
+        self.__order = []
+        self.__limit = None
+        self.__offset = None
+        self.__related = []
+        self.__only = None
+        self.__defer = []
+        self.__undeferred = False
+        self.__annotations = {}
+
+    def __iter__(self):
+        return self.iterator()
+
+    def filter(self, **conditions):
+        # conditions are <name>=value or <name>__<operator>=value joined with AND
+        # name is a column, a parent, id, created or updated
+        # operators: exact, ne, lt, lte, gt, gte, like, ilike, in, isnull
+        query = self.__clone()
+        for key, value in conditions.items():
+            name, operator = key, 'exact'
+            head, _, tail = key.rpartition('__')
+            if head and (tail in self.__operators or tail in ('in', 'isnull')):
+                name, operator = head, tail
+
+            column = self.__column(name)
+            if operator == 'isnull':
+                query.__where.append(f'{column} IS {"" if value else "NOT "}NULL')
+            elif operator == 'in':
+                query.__where.append(f'{column} = ANY(%s)')
+                query.__args.append([self.__value(v) for v in value])
+            elif value is None and operator in ('exact', 'ne'):
+                query.__where.append(f'{column} IS {"" if operator == "exact" else "NOT "}NULL')
+            else:
+                query.__where.append(f'{column} {self.__operators[operator]} %s')
+                query.__args.append(self.__value(value))
+        return query
+
+    def order_by(self, *names):
+        # '-name' sorts in descending order
+        query = self.__clone()
+        for name in names:
+            if name.startswith('-'):
+                query.__order.append(f'{self.__column(name[1:])} DESC')
             else:
-                self.__update()
-        if self.__children:
-            self.__update_chldr()
-        if self.__siblings:
-            self.__insert_sbl()
+                query.__order.append(self.__column(name))
+        return query
+
+    def select_related(self, *names):
+        # load given parents in the same query with LEFT JOINs, so reading them doesn't query a database
+        query = self.__clone()
+        for name in names:
+            if name not in self.__entity_class._parents:
+                raise AttributeError(name)
+            if name not in query.__related:
+                query.__related.append(name)
+        return query
+
+    def only(self, *names):
+        # select only id and given columns or parents, others are deferred:
+        # they are loaded on first access for all instances of the result at once
+        query = self.__clone()
+        query.__only = [self.__checked(name) for name in names]
+        return query
+
+    def defer(self, *names):
+        # leave given columns or parents out of the select, they are loaded like with only()
+        query = self.__clone()
+        query.__defer.extend(self.__checked(name) for name in names)
+        return query
+
+    def annotate(self, **aggregates):
+        # add aggregates of children or siblings to every instance, e.g. annotate(post_count=Count('posts')):
+        # each relation is grouped once in a joined subquery, so no related row is fetched
+        # annotations can be used in filter() and order_by() and are read as attributes of instances
+        query = self.__clone()
+        for name, aggregate in aggregates.items():
+            if name in self.__annotations:
+                raise AttributeError(name)
+            query.__annotations[name] = aggregate
+        self.__entity_class._aggregate_relations(query.__annotations)
+        return query
+
+    def limit(self, count):
+        query = self.__clone()
+        query.__limit = count
+        return query
+
+    def offset(self, count):
+        query = self.__clone()
+        query.__offset = count
+        return query
+
+    def all(self):
+        # return an array of instances fetched in one round trip
+        query, args = self.sql()
+        return self.__entity_class._fetch(query, args, self.__related, self.__deferred(), tuple(self.__annotations))
+
+    def rows(self):
+        # return an array of read-only Row tuples fetched in one round trip
+        query, args = self.sql(related=False)
+        return self.__entity_class._fetch_rows(query, args)
+
+    def first(self):
+        # return the first instance or None
+        result = self.limit(1).all()
+        return result[0] if result else None
+
+    def iterator(self, batch_size=1000):
+        # yield instances, reading batch_size rows per round trip
+        query, args = self.sql()
+        return self.__entity_class._stream(query, args, batch_size, self.__related, self.__deferred(),
+                                           tuple(self.__annotations))
+
+    def count(self):
+        # return a number of matching rows without fetching them
+        query, args = self.sql(related=False)
+        return self.__entity_class._scalar(self.__count_query.format(query=query), args)
+
+    def exists(self):
+        # check, if there is at least one matching row without fetching it
+        query, args = self.limit(1).sql(related=False)
+        return self.__entity_class._scalar(self.__exists_query.format(query=query), args)
+
+    def delete(self, cascade=False):
+        # delete matching rows and return their number, ids are selected first and then every table
+        # is deleted with one statement, with cascade children and pivot rows of siblings are deleted too
+        query, args = self.only().sql(related=False)
+        return self.__entity_class._delete_selected(query, args, cascade)
+
+    def aggregate(self, **aggregates):
+        # return a dict of aggregates over matching rows computed by the database, e.g.
+        #     Post.query().filter(category=1).aggregate(total=Count('id'), newest=Max('created'))
+        # the inner select keeps every column, deferred ones of the class too, so any of them can be aggregated
+        query = self.__clone()
+        query.__undeferred = True
+        query, args = query.sql(related=False)
+
+        selected = []
+        for name, aggregate in aggregates.items():
+            if aggregate.path in self.__annotations:
+                expression = f'"{self.__table}"."{aggregate.path}"'
+            else:
+                expression = self.__entity_class._column_sql(aggregate.path)
+            selected.append(f'{aggregate.sql(expression)} AS "{name}"')
+
+        query = self.__aggregate_query.format(aggregates=", ".join(selected), query=query, table=self.__table)
+        row = self.__entity_class._fetch_one(query, args)
+        return {name: row[name] for name in aggregates}
+
+    def sql(self, related=True):
+        # return a query string with its arguments
+        # related=False leaves out joins of select_related
+        joins = ''
+        columns, _ = self.__entity_class._select_columns(self.__only, self.__defer,
+                                                         qualified=related and bool(self.__related)
+                                                         or bool(self.__annotations),
+                                                         undeferred=self.__undeferred)
+        if self.__annotations:
+            for name, source, owner, selected in self.__entity_class._aggregate_relations(self.__annotations):
+                alias = f'{name}__aggregates'
+                joins += self.__annotate_join.format(owner=owner, source=source, alias=alias, table=self.__table,
+                                                     aggregates=", ".join(f'{sql} AS "{key}"'
+                                                                          for key, sql, _ in selected))
+            for name in self.__annotations:
+                columns += self.__annotate_columns.format(value=self.__annotated(name), name=name)
+
+        if related and self.__related:
+            for name in self.__related:
+                columns += self.__related_columns.format(parent=name)
+                joins += self.__related_join.format(parent=name, table=self.__table)
+
+        where = f' WHERE {" AND ".join(self.__where)}' if self.__where else ''
+        order = f' ORDER BY {", ".join(self.__order)}' if self.__order else ''
+        args = list(self.__args)
+
+        limit = ''
+        if self.__limit is not None:
+            limit += ' LIMIT %s'
+            args.append(self.__limit)
+        if self.__offset is not None:
+            limit += ' OFFSET %s'
+            args.append(self.__offset)
+
+        query = self.__select_query.format(columns=columns, table=self.__table, joins=joins,
+                                           where=where, order=order, limit=limit)
+        return query, tuple(args)
+
+    def __clone(self):
+        query = Query(self.__entity_class)
+        query.__where = list(self.__where)
+        query.__args = list(self.__args)
+        query.__order = list(self.__order)
+        query.__limit = self.__limit
+        query.__offset = self.__offset
+        query.__related = list(self.__related)
+        query.__only = self.__only
+        query.__defer = list(self.__defer)
+        query.__undeferred = self.__undeferred
+        query.__annotations = dict(self.__annotations)
+        return query
+
+    def __annotated(self, name):
+        # return an annotation value, relations without rows get the default of the aggregate
+        aggregate = self.__annotations[name]
+        relation = aggregate.path.partition('__')[0]
+        value = f'"{relation}__aggregates"."{name}"'
+        if aggregate.default is not None:
+            value = f'coalesce({value}, {aggregate.default})'
+        return value
+
+    def __deferred(self):
+        return self.__entity_class._select_columns(self.__only, self.__defer)[1]
+
+    def __checked(self, name):
+        # only columns and parents can be deferred
+        if name not in self.__entity_class._columns and name not in self.__entity_class._parents:
+            raise AttributeError(name)
+        return name
+
+    def __column(self, name):
+        # return a qualified column or an annotation for an attribute name
+        if name in self.__annotations:
+            return self.__annotated(name)
+        return self.__entity_class._column_sql(name)
+
+    @staticmethod
+    def __value(value):
+        # entity instances are compared by id
+        if isinstance(value, Entity):
+            return value.id
+        return value
@@ -0,0 +1,414 @@
+import argparse
+import copy
+import json
+import re
+
+import psycopg2
+
+from my_classes import Generator, parse_yaml_schema, write_to_file
+
+
+class MigrationException(Exception):
+    pass
+
+
+_columns_query = 'SELECT c.table_name, c.column_name, c.data_type, c.character_maximum_length, ' \
+                 'c.numeric_precision, c.numeric_scale ' \
+                 'FROM information_schema.columns AS c JOIN information_schema.tables AS t ' \
+                 'ON t.table_schema = c.table_schema AND t.table_name = c.table_name ' \
+                 'WHERE c.table_schema = %s AND t.table_type = \'BASE TABLE\' ' \
+                 'ORDER BY c.table_name, c.ordinal_position'
+_constraints_query = 'SELECT tc.constraint_type, tc.constraint_name, tc.table_name, kcu.column_name, ' \
+                     'ccu.table_name ' \
+                     'FROM information_schema.table_constraints AS tc ' \
+                     'JOIN information_schema.key_column_usage AS kcu ' \
+                     'ON kcu.constraint_schema = tc.constraint_schema AND kcu.constraint_name = tc.constraint_name ' \
+                     'JOIN information_schema.constraint_column_usage AS ccu ' \
+                     'ON ccu.constraint_schema = tc.constraint_schema AND ccu.constraint_name = tc.constraint_name ' \
+                     'WHERE tc.table_schema = %s AND tc.constraint_type IN (\'PRIMARY KEY\', \'FOREIGN KEY\') ' \
+                     'ORDER BY tc.constraint_name, kcu.ordinal_position'
+# information_schema doesn't describe indexes, they are read from pg_catalog
+_indexes_query = 'SELECT i.relname, t.relname, array_agg(a.attname ORDER BY k.n) ' \
+                 'FROM pg_index AS x ' \
+                 'JOIN pg_class AS i ON i.oid = x.indexrelid ' \
+                 'JOIN pg_class AS t ON t.oid = x.indrelid ' \
+                 'JOIN pg_namespace AS s ON s.oid = t.relnamespace ' \
+                 'CROSS JOIN unnest(x.indkey) WITH ORDINALITY AS k (attnum, n) ' \
+                 'JOIN pg_attribute AS a ON a.attrelid = t.oid AND a.attnum = k.attnum ' \
+                 'WHERE s.nspname = %s AND NOT x.indisprimary ' \
+                 'GROUP BY i.relname, t.relname'
+_triggers_query = 'SELECT t.relname, p.prosrc ' \
+                  'FROM pg_trigger AS g ' \
+                  'JOIN pg_class AS t ON t.oid = g.tgrelid ' \
+                  'JOIN pg_namespace AS s ON s.oid = t.relnamespace ' \
+                  'JOIN pg_proc AS p ON p.oid = g.tgfoid ' \
+                  'WHERE s.nspname = %s AND g.tgname = \'tr_\' || t.relname || \'_updated\''
+
+_type_aliases = {
+    'bool': 'boolean',
+    'char': 'character',
+    'decimal': 'numeric',
+    'float': 'double precision',
+    'float4': 'real',
+    'float8': 'double precision',
+    'int': 'integer',
+    'int2': 'smallint',
+    'int4': 'integer',
+    'int8': 'bigint',
+    'serial': 'integer',
+    'timestamp': 'timestamp without time zone',
+    'timestamptz': 'timestamp with time zone',
+    'varchar': 'character varying',
+}
+
+
+def normalize_type(column_type: str) -> str:
+    # spell a yaml column type the way information_schema does, e.g. varchar(50) is character varying(50)
+    match = re.fullmatch(r'\s*([a-z0-9 ]+?)\s*(\(([\d\s,]+)\))?\s*', column_type.lower())
+    if match is None:
+        return column_type.lower()
+    name = _type_aliases.get(match.group(1), match.group(1))
+    if match.group(3):
+        return f'{name}({match.group(3).replace(" ", "")})'
+    if name == 'character':
+        return 'character(1)'
+    return name
+
+
+def introspect_schema(db, schema='public') -> dict:
+    # read a snapshot of tables, columns, primary keys, foreign keys, indexes and update triggers of a live database
+    snapshot = {'tables': {}, 'foreign_keys': {}, 'indexes': {}, 'triggers': {}}
+    cursor = db.cursor()
+
+    cursor.execute(_columns_query, (schema,))
+    for table, column, data_type, length, precision, scale in cursor.fetchall():
+        if data_type in ('character varying', 'character') and length is not None:
+            data_type = f'{data_type}({length})'
+        elif data_type == 'numeric' and precision is not None:
+            data_type = f'numeric({precision},{scale})'
+        snapshot['tables'].setdefault(table, {'columns': {}, 'primary_key': []})['columns'][column] = data_type
+
+    cursor.execute(_constraints_query, (schema,))
+    for constraint_type, name, table, column, reference in cursor.fetchall():
+        if constraint_type == 'PRIMARY KEY':
+            if column not in snapshot['tables'][table]['primary_key']:
+                snapshot['tables'][table]['primary_key'].append(column)
+        else:
+            snapshot['foreign_keys'][name] = [table, column, reference]
+
+    cursor.execute(_indexes_query, (schema,))
+    for name, table, columns in cursor.fetchall():
+        snapshot['indexes'][name] = [table, list(columns)]
+
+    # triggers created before the version of <table>_updated was made to grow on every update
+    # set the same value for updates within one second, which optimistic locking can't tell apart
+    cursor.execute(_triggers_query, (schema,))
+    for table, source in cursor.fetchall():
+        snapshot['triggers'][table] = 'versioned' if 'greatest(' in source else 'same_second'
+
+    db.rollback()
+    return snapshot
+
+
+def schema_snapshot(raw_dict: dict) -> dict:
+    # build the snapshot Generator.generate_scheme would create for a yaml schema from its relation graph
+    graph = Generator(raw_dict).relation_graph()
+    snapshot = {'tables': {}, 'foreign_keys': {}, 'indexes': {}, 'triggers': {}}
+
+    for table in graph.tables:
+        columns = {f'{table}_id': 'integer'}
+        columns.update((column, normalize_type(column_type)) for column, column_type in graph.fields[table])
+        columns[f'{table}_created'] = 'integer'
+        columns[f'{table}_updated'] = 'integer'
+        snapshot['tables'][table] = {'columns': columns, 'primary_key': [f'{table}_id']}
+        snapshot['triggers'][table] = 'versioned'
+
+    for pivot_name, pivot_tables in graph.pivots.items():
+        keys = [f'{pivot_table}_id' for pivot_table in pivot_tables]
+        snapshot['tables'][pivot_name] = {'columns': {key: 'integer' for key in keys}, 'primary_key': keys}
+        snapshot['indexes'][f'ix_{pivot_name}_{keys[1]}'] = [pivot_name, [keys[1]]]
+
+    for table in graph.tables:
+        for kind, relation_table, pivot_name in graph.relations[table]:
+            if kind == 'one':
+                snapshot['tables'][table]['columns'][f'{relation_table}_id'] = 'integer'
+                snapshot['foreign_keys'][f'fk_{table}_{relation_table}_id'] = \
+                    [table, f'{relation_table}_id', relation_table]
+                snapshot['indexes'][f'ix_{table}_{relation_table}_id'] = [table, [f'{relation_table}_id']]
+            else:
+                snapshot['foreign_keys'][f'fk_{pivot_name}_{table}_id'] = [pivot_name, f'{table}_id', table]
+
+        for columns in graph.indexes[table]:
+            snapshot['indexes'][f'ix_{table}_{"_".join(columns)}'] = [table, columns]
+
+    return snapshot
+
+
+def load_snapshot(snapshot_path: str) -> dict:
+    with open(snapshot_path, encoding='utf8') as file:
+        return json.load(file)
+
+
+def save_snapshot(snapshot_path: str, snapshot: dict):
+    with open(snapshot_path, 'w', encoding='utf8') as file:
+        json.dump(snapshot, file, indent=2, sort_keys=True)
+
+
+def apply_migration(db, queries: list):
+    # CREATE INDEX CONCURRENTLY and batches committing inside DO blocks can't run in a transaction,
+    # so every statement is committed on its own
+    db.autocommit = True
+    cursor = db.cursor()
+    for query in queries:
+        cursor.execute(query)
+
+
+class Migration:
+    """Migration diffs a current schema snapshot against a yaml schema and creates minimal statements to migrate it
+
+    Statements avoid long locks of big tables: indexes are built concurrently, foreign keys are validated
+    after they are added, and a column type change that needs a table rewrite fills a new column
+    in committed batches and swaps it in at the end (the batches fire update triggers, so <table>_updated
+    of every row changes). Update triggers of existing tables which set the same <table>_updated for updates
+    within one second are replaced, so optimistic locking sees every update. Tables, columns and foreign keys
+    missing from the yaml
+    schema are dropped only with allow_drop. Foreign key columns added to existing tables stay nullable
+    until every row has a value.
+    """
+
+    def __init__(self, current, raw_dict, batch_size=10000, allow_drop=False):
+        self.__queries = []
+        self.__current = copy.deepcopy(current)
+        self.__desired = schema_snapshot(raw_dict)
+        self.__batch_size = batch_size
+        self.__allow_drop = allow_drop
+
+    def create_tables(self):
+        foreign_keys = [[table, column] for table, column, _ in self.__desired['foreign_keys'].values()]
+        for table, description in self.__desired['tables'].items():
+            if table in self.__current['tables']:
+                continue
+
+            body_query = []
+            for column, column_type in description['columns'].items():
+                if description['primary_key'] == [column]:
+                    body_query.append(f'\n    "{column}" SERIAL PRIMARY KEY')
+                elif column in (f'{table}_created', f'{table}_updated'):
+                    body_query.append(f'\n    "{column}" '
+                                      f'INTEGER NOT NULL DEFAULT cast(extract(epoch from now()) AS INTEGER)')
+                elif [table, column] in foreign_keys:
+                    body_query.append(f'\n    "{column}" {column_type} NOT NULL')
+                else:
+                    body_query.append(f'\n    "{column}" {column_type}')
+            if len(description['primary_key']) > 1:
+                primary_key = ", ".join(f'"{column}"' for column in description['primary_key'])
+                body_query.append(f'\n    PRIMARY KEY ({primary_key})')
+            self.__queries.append(f'CREATE TABLE "{table}" ({",".join(body_query)}\n);')
+
+            if f'{table}_updated' in description['columns']:
+                self.__queries.append(self.__trigger_query(table))
+
+    def alter_columns(self):
+        # new columns and type changes which don't rewrite a table are changes of the catalog only
+        for table, description in self.__desired['tables'].items():
+            current = self.__current['tables'].get(table)
+            if current is None:
+                continue
+
+            for column, column_type in description['columns'].items():
+                current_type = current['columns'].get(column)
+                if current_type is None:
+                    self.__queries.append(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {column_type};')
+                elif current_type != column_type and not self.__rewrites(current_type, column_type):
+                    self.__queries.append(f'ALTER TABLE "{table}" ALTER COLUMN "{column}" TYPE {column_type};')
+
+    def replace_triggers(self):
+        # existing tables get the update trigger setting a new version on every update,
+        # an outdated trigger only needs its function replaced
+        # snapshots saved without triggers come from tables created with them, their functions are replaced
+        triggers = self.__current.get('triggers')
+        for table in self.__desired['triggers']:
+            if table not in self.__current['tables'] or triggers and triggers.get(table) == 'versioned':
+                continue
+            if triggers is None or table in triggers:
+                self.__queries.append(self.__function_query(table))
+            else:
+                self.__queries.append(self.__trigger_query(table))
+
+    def add_foreign_keys(self):
+        # on existing tables NOT VALID skips checking existing rows while the table is locked,
+        # they are checked by VALIDATE which doesn't block writes, new tables have no rows to check
+        for name, (table, column, reference) in self.__desired['foreign_keys'].items():
+            if name in self.__current['foreign_keys']:
+                continue
+
+            existing = table in self.__current['tables']
+            self.__queries.append(f'ALTER TABLE "{table}"\n    ADD CONSTRAINT "{name}" FOREIGN KEY ("{column}") '
+                                  f'REFERENCES "{reference}" ("{reference}_id"){" NOT VALID" if existing else ""};')
+            if existing:
+                self.__queries.append(f'ALTER TABLE "{table}" VALIDATE CONSTRAINT "{name}";')
+
+    def rewrite_columns(self):
+        # a column with a changed type is filled by a trigger and by batches committed one by one,
+        # then the filled column replaces the old one in one short transaction
+        for table, description in self.__desired['tables'].items():
+            current = self.__current['tables'].get(table)
+            if current is None:
+                continue
+
+            for column, column_type in description['columns'].items():
+                current_type = current['columns'].get(column)
+                if current_type is None or current_type == column_type or \
+                        not self.__rewrites(current_type, column_type):
+                    continue
+
+                if column in current['primary_key']:
+                    raise MigrationException(f'Primary key column: {column} can\'t change its type')
+
+                new_column = f'{column}__new'
+                self.__queries.append(f'ALTER TABLE "{table}" ADD COLUMN "{new_column}" {column_type};')
+                self.__queries.append(f'CREATE OR REPLACE FUNCTION migrate_{table}_{column}()\n'
+                                      f'RETURNS TRIGGER AS $$\n'
+                                      f'BEGIN\n'
+                                      f'    NEW.{new_column} = NEW.{column}::{column_type};\n'
+                                      f'    RETURN NEW;\n'
+                                      f'END;\n'
+                                      f'$$ language "plpgsql";\n'
+                                      f'CREATE TRIGGER "tr_{table}_{column}_migrate" BEFORE INSERT OR UPDATE '
+                                      f'ON "{table}" FOR EACH ROW EXECUTE PROCEDURE migrate_{table}_{column}();')
+                self.__queries.append(self.__backfill_query(table, column, new_column, column_type))
+                self.__queries.append(f'BEGIN;\n'
+                                      f'DROP TRIGGER "tr_{table}_{column}_migrate" ON "{table}";\n'
+                                      f'DROP FUNCTION migrate_{table}_{column}();\n'
+                                      f'ALTER TABLE "{table}" DROP COLUMN "{column}";\n'
+                                      f'ALTER TABLE "{table}" RENAME COLUMN "{new_column}" TO "{column}";\n'
+                                      f'COMMIT;')
+
+                # indexes of a dropped column are dropped with it
+                for name, (index_table, columns) in self.__desired['indexes'].items():
+                    if index_table == table and column in columns:
+                        self.__current['indexes'].pop(name, None)
+
+    def create_indexes(self):
+        for name, (table, columns) in self.__desired['indexes'].items():
+            if name in self.__current['indexes']:
+                continue
+
+            index_columns = ", ".join(f'"{column}"' for column in columns)
+            self.__queries.append(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{table}" ({index_columns});')
+
+    def drop_removed(self):
+        # only indexes named by the generator are dropped, indexes created by hand are kept
+        for name in self.__current['indexes']:
+            if name.startswith('ix_') and name not in self.__desired['indexes']:
+                self.__queries.append(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}";')
+
+        if not self.__allow_drop:
+            return
+
+        for name, (table, _, _) in self.__current['foreign_keys'].items():
+            if name not in self.__desired['foreign_keys']:
+                self.__queries.append(f'ALTER TABLE "{table}" DROP CONSTRAINT IF EXISTS "{name}";')
+
+        for table, description in self.__current['tables'].items():
+            if table not in self.__desired['tables']:
+                continue
+            for column in description['columns']:
+                if column not in self.__desired['tables'][table]['columns']:
+                    self.__queries.append(f'ALTER TABLE "{table}" DROP COLUMN "{column}";')
+
+        for table in self.__current['tables']:
+            if table not in self.__desired['tables']:
+                self.__queries.append(f'DROP TABLE "{table}";')
+
+    def generate_migration(self):
+        self.create_tables()
+        self.alter_columns()
+        self.replace_triggers()
+        self.add_foreign_keys()
+        self.rewrite_columns()
+        self.create_indexes()
+        self.drop_removed()
+        return self.__queries
+
+    def __backfill_query(self, table, column, new_column, column_type):
+        # COMMIT inside DO needs PostgreSQL 11 and a statement run outside of a transaction block
+        return f'DO $$\n' \
+               f'DECLARE\n' \
+               f'    last_id integer := 0;\n' \
+               f'    max_id integer;\n' \
+               f'BEGIN\n' \
+               f'    SELECT coalesce(max({table}_id), 0) INTO max_id FROM "{table}";\n' \
+               f'    WHILE last_id < max_id LOOP\n' \
+               f'        UPDATE "{table}" SET "{new_column}" = "{column}"::{column_type}\n' \
+               f'            WHERE {table}_id > last_id AND {table}_id <= last_id + {self.__batch_size};\n' \
+               f'        last_id := last_id + {self.__batch_size};\n' \
+               f'        COMMIT;\n' \
+               f'    END LOOP;\n' \
+               f'END\n' \
+               f'$$;'
+
+    @staticmethod
+    def __rewrites(current_type, column_type):
+        # widening varchar or turning it into text is the only change PostgreSQL does without a table rewrite
+        current_match = re.fullmatch(r'character varying(\((\d+)\))?|text', current_type)
+        match = re.fullmatch(r'character varying(\((\d+)\))?|text', column_type)
+        if current_match is None or match is None:
+            return True
+        if column_type == 'text' or match.group(2) is None:
+            return False
+        if current_type == 'text' or current_match.group(2) is None:
+            return True
+        return int(match.group(2)) < int(current_match.group(2))
+
+    @staticmethod
+    def __function_query(table):
+        return f'CREATE OR REPLACE FUNCTION update_{table}_timestamp()\n' \
+               f'RETURNS TRIGGER AS $$\n' \
+               f'BEGIN\n' \
+               f'    NEW.{table}_updated = greatest(cast(extract(epoch from now()) as integer), OLD.{table}_updated + 1);\n' \
+               f'    RETURN NEW;\n' \
+               f'END;\n' \
+               f'$$ language "plpgsql";'
+
+    @classmethod
+    def __trigger_query(cls, table):
+        return f'{cls.__function_query(table)}\n' \
+               f'CREATE TRIGGER "tr_{table}_updated" BEFORE UPDATE ON "{table}" ' \
+               f'FOR EACH ROW EXECUTE PROCEDURE update_{table}_timestamp();'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write statements migrating a database to a yaml schema')
+    parser.add_argument('schema', help='yaml schema')
+    parser.add_argument('output', help='sql file the statements are written to')
+    parser.add_argument('--dsn', help='introspect the live schema of this database')
+    parser.add_argument('--snapshot', help='json snapshot of the current schema used without --dsn, '
+                                           'it is updated to the yaml schema after the statements are written '
+                                           'or applied with --apply')
+    parser.add_argument('--apply', action='store_true', help='run the statements on --dsn')
+    parser.add_argument('--allow-drop', action='store_true', help='drop tables, columns and foreign keys')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    options = parser.parse_args()
+
+    if not options.dsn and not options.snapshot:
+        parser.error('either --dsn or --snapshot is required')
+
+    raw_dict = parse_yaml_schema(options.schema)
+    db = psycopg2.connect(options.dsn) if options.dsn else None
+    try:
+        current = introspect_schema(db) if db is not None else load_snapshot(options.snapshot)
+        queries = Migration(current, raw_dict, options.batch_size, options.allow_drop).generate_migration()
+        write_to_file(options.output, queries, mode='w')
+
+        if options.apply and db is not None:
+            apply_migration(db, queries)
+        if options.snapshot and (options.apply or db is None):
+            save_snapshot(options.snapshot, schema_snapshot(raw_dict))
+    finally:
+        if db is not None:
+            db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -69,10 +69,16 @@ ALTER TABLE "comment" ADD "post_id" INTEGER NOT NULL,
 ALTER TABLE "category" ADD "section_id" INTEGER NOT NULL,
     ADD CONSTRAINT "fk_category_section_id" FOREIGN KEY ("section_id") REFERENCES "section" ("section_id");
 
+CREATE INDEX "ix_post_category_id" ON "post" ("category_id");
+CREATE INDEX "ix_comment_user_id" ON "comment" ("user_id");
+CREATE INDEX "ix_comment_post_id" ON "comment" ("post_id");
+CREATE INDEX "ix_category_section_id" ON "category" ("section_id");
+CREATE INDEX "ix_post__tag_tag_id" ON "post__tag" ("tag_id");
+
 CREATE OR REPLACE FUNCTION update_section_timestamp()
 RETURNS TRIGGER AS $$
 BEGIN
-   NEW.section_updated = cast(extract(epoch from now()) as integer);
+   NEW.section_updated = greatest(cast(extract(epoch from now()) as integer), OLD.section_updated + 1);
    RETURN NEW;
 END;
 $$ language 'plpgsql';
@@ -81,7 +87,7 @@ CREATE TRIGGER "tr_section_updated" BEFORE UPDATE ON "section" FOR EACH ROW EXEC
 CREATE OR REPLACE FUNCTION update_user_timestamp()
 RETURNS TRIGGER AS $$
 BEGIN
-   NEW.user_updated = cast(extract(epoch from now()) as integer);
+   NEW.user_updated = greatest(cast(extract(epoch from now()) as integer), OLD.user_updated + 1);
    RETURN NEW;
 END;
 $$ language 'plpgsql';
@@ -90,7 +96,7 @@ CREATE TRIGGER "tr_user_updated" BEFORE UPDATE ON "user" FOR EACH ROW EXECUTE PR
 CREATE OR REPLACE FUNCTION update_category_timestamp()
 RETURNS TRIGGER AS $$
 BEGIN
-   NEW.category_updated = cast(extract(epoch from now()) as integer);
+   NEW.category_updated = greatest(cast(extract(epoch from now()) as integer), OLD.category_updated + 1);
    RETURN NEW;
 END;
 $$ language 'plpgsql';
@@ -99,7 +105,7 @@ CREATE TRIGGER "tr_category_updated" BEFORE UPDATE ON "category" FOR EACH ROW EX
 CREATE OR REPLACE FUNCTION update_post_timestamp()
 RETURNS TRIGGER AS $$
 BEGIN
-   NEW.post_updated = cast(extract(epoch from now()) as integer);
+   NEW.post_updated = greatest(cast(extract(epoch from now()) as integer), OLD.post_updated + 1);
    RETURN NEW;
 END;
 $$ language 'plpgsql';
@@ -108,7 +114,7 @@ CREATE TRIGGER "tr_post_updated" BEFORE UPDATE ON "post" FOR EACH ROW EXECUTE PR
 CREATE OR REPLACE FUNCTION update_tag_timestamp()
 RETURNS TRIGGER AS $$
 BEGIN
-   NEW.tag_updated = cast(extract(epoch from now()) as integer);
+   NEW.tag_updated = greatest(cast(extract(epoch from now()) as integer), OLD.tag_updated + 1);
    RETURN NEW;
 END;
 $$ language 'plpgsql';
@@ -117,7 +123,7 @@ CREATE TRIGGER "tr_tag_updated" BEFORE UPDATE ON "tag" FOR EACH ROW EXECUTE PROC
 CREATE OR REPLACE FUNCTION update_comment_timestamp()
 RETURNS TRIGGER AS $$
 BEGIN
-   NEW.comment_updated = cast(extract(epoch from now()) as integer);
+   NEW.comment_updated = greatest(cast(extract(epoch from now()) as integer), OLD.comment_updated + 1);
    RETURN NEW;
 END;
 $$ language 'plpgsql';
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from my_entity import Entity  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def entity_settings():
+    # every test starts without a connection, a cache or replicas and leaves none behind
+    saved = Entity.db, Entity.pool, Entity.cache, Entity.replicas
+    Entity.db = Entity.pool = Entity.cache = Entity.replicas = None
+    yield
+    Entity.db, Entity.pool, Entity.cache, Entity.replicas = saved
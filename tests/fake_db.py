@@ -0,0 +1,55 @@
+# stand-in for a psycopg2 connection: every statement is recorded and answered by respond(query, args),
+# which returns a list of rows as dicts, or raises to simulate a failing server
+
+
+class FakeCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rowcount = -1
+        self.__rows = []
+
+    def execute(self, query, args=None):
+        if self.connection.closed:
+            raise self.connection.closed_error('connection already closed')
+        self.connection.queries.append(query)
+        self.__rows = list(self.connection.respond(query, args))
+        self.rowcount = len(self.__rows)
+
+    def fetchall(self):
+        rows, self.__rows = self.__rows, []
+        return rows
+
+    def fetchone(self):
+        return self.__rows.pop(0) if self.__rows else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, respond=None, name='db'):
+        import psycopg2
+        self.name = name
+        self.respond = respond or (lambda query, args: [])
+        self.closed_error = psycopg2.InterfaceError
+        self.queries = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.autocommit = False
+        self.closed = False
+
+    def cursor(self, name=None, cursor_factory=None, withhold=False):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
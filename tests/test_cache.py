@@ -0,0 +1,135 @@
+import pytest
+
+import my_cache
+from my_cache import FakeRedis, MemoryBackend, RedisBackend, ResultCache
+from my_entity import Entity
+from tests.fake_db import FakeConnection
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(my_cache.time, 'monotonic', clock)
+    return clock
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(maxsize=2)
+    backend.set('a', 1)
+    backend.set('b', 2)
+    assert backend.get('a') == 1
+    backend.set('c', 3)
+
+    assert backend.get('b') is None
+    assert backend.get('a') == 1
+    assert backend.get('c') == 3
+    assert len(backend) == 2
+
+
+def test_memory_backend_expires_values(clock):
+    backend = MemoryBackend()
+    backend.set('a', 1, ttl=10)
+    backend.set('b', 2)
+
+    clock.now += 9
+    assert backend.get('a') == 1
+    clock.now += 1
+    assert backend.get('a') is None
+    assert backend.get('b') == 2
+
+
+def test_memory_backend_keeps_counters_on_eviction():
+    backend = MemoryBackend(maxsize=1)
+    backend.incr('generation')
+    backend.set('a', 1)
+    backend.set('b', 2)
+
+    assert backend.counter('generation') == 1
+    assert backend.counter('missing') == 0
+
+
+def test_fake_redis_stores_bytes_and_expires(clock):
+    client = FakeRedis()
+    client.set('a', 'value', ex=5)
+    assert client.get('a') == b'value'
+    assert client.incr('n') == 1 and client.incr('n') == 2
+    assert client.get('n') == b'2'
+
+    clock.now += 5
+    assert client.get('a') is None
+    assert client.flushdb() and client.dbsize() == 0
+
+
+def test_redis_backend_pickles_values():
+    backend = RedisBackend(FakeRedis(), prefix='test:')
+    backend.set(('post', 1, None), [{'post_id': 1}], ttl=60)
+
+    assert backend.get(('post', 1, None)) == [{'post_id': 1}]
+    assert backend.get(('post', 2, None)) is None
+    assert backend.counter('generation') == 0
+    assert backend.incr('generation') == 1
+    assert backend.counter('generation') == 1
+
+
+@pytest.mark.parametrize('backend', [MemoryBackend(), RedisBackend(FakeRedis())], ids=['memory', 'redis'])
+def test_result_cache_counts_hits_and_invalidates_tables(backend):
+    cache = ResultCache(backend)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return [{'post_id': 1}]
+
+    assert cache.fetch(('post', 1), ('post',), load) == [{'post_id': 1}]
+    assert cache.fetch(('post', 1), ('post',), load) == [{'post_id': 1}]
+    assert len(loads) == 1
+
+    cache.invalidate('comment')
+    cache.fetch(('post', 1), ('post',), load)
+    assert len(loads) == 1
+
+    cache.invalidate('post')
+    cache.fetch(('post', 1), ('post',), load)
+    assert len(loads) == 2
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'ratio': 0.5}
+
+
+def test_result_cache_expires_values(clock):
+    cache = ResultCache(MemoryBackend(), ttl=60)
+    cache.fetch('key', ('post',), lambda: [1])
+    clock.now += 60
+    cache.fetch('key', ('post',), lambda: [1])
+    assert cache.stats()['misses'] == 2
+
+
+class Note(Entity):
+    __slots__ = ()
+    _columns = ['title']
+    _parents = []
+    _children = {}
+    _siblings = {}
+
+
+def test_session_reads_are_not_cached():
+    db = FakeConnection(lambda query, args: [{'note_id': 1, 'note_title': 'a'}] if query.startswith('SELECT') else [])
+    Entity.db = db
+    Entity.cache = ResultCache()
+
+    with Entity.transaction():
+        Note.all()
+        Note.all()
+    assert len(db.queries) == 2
+    assert len(Entity.cache.backend) == 0
+
+    Note.all()
+    Note.all()
+    assert len(db.queries) == 3
+    assert Entity.cache.stats()['hits'] == 1
@@ -0,0 +1,70 @@
+from my_entity import Entity
+from tests.fake_db import FakeConnection
+
+
+class Shelf(Entity):
+    __slots__ = ()
+    _columns = ['name']
+    _parents = []
+    _children = {'books': 'Book'}
+    _siblings = {}
+
+
+class Book(Entity):
+    __slots__ = ()
+    _columns = ['title']
+    _parents = ['shelf']
+    _children = {'pages': 'Page'}
+    _siblings = {}
+
+
+class Page(Entity):
+    __slots__ = ()
+    _columns = ['text']
+    _parents = ['book']
+    _children = {}
+    _siblings = {}
+
+
+def respond(query, args):
+    if 'pg_attribute' in query:
+        return [['shelf_id', 'integer'], ['shelf_name', 'text']]
+    if query.startswith('SELECT "shelf_id"'):
+        return [[1]]
+    if query.startswith('SELECT * FROM "book"'):
+        return [{'book_id': 5, 'book_title': 'a', 'shelf_id': 1}]
+    if query.startswith('SELECT * FROM "page"'):
+        return [{'page_id': 7, 'page_text': 'a', 'book_id': 5}]
+    if query.startswith('SELECT * FROM "shelf"'):
+        return [{'shelf_id': 2, 'shelf_name': 'kept'}]
+    return []
+
+
+def test_cascade_forgets_deleted_children():
+    db = FakeConnection(respond)
+    Entity.db = db
+    book = Book._fetch('SELECT * FROM "book"', ())[0]
+    page = Page._fetch('SELECT * FROM "page"', ())[0]
+    kept = Shelf._fetch('SELECT * FROM "shelf"', ())[0]
+    assert page.book is book
+
+    Shelf(1).delete(cascade=True)
+
+    assert [query.split(' WHERE')[0] for query in db.queries[3:]] == \
+        ['DELETE FROM "page"', 'DELETE FROM "book"', 'DELETE FROM "shelf"']
+    identity_map = Entity.identity_map()
+    assert (Book, 5) not in identity_map
+    assert (Page, 7) not in identity_map
+    assert identity_map[(Shelf, 2)] is kept
+
+
+def test_query_delete_forgets_deleted_rows():
+    Entity.db = FakeConnection(respond)
+    Book._fetch('SELECT * FROM "book"', ())
+    kept = Shelf._fetch('SELECT * FROM "shelf"', ())[0]
+
+    Shelf.query().filter(id=1).delete(cascade=True)
+
+    identity_map = Entity.identity_map()
+    assert (Book, 5) not in identity_map
+    assert identity_map[(Shelf, 2)] is kept
@@ -0,0 +1,22 @@
+import re
+
+from my_classes import Generator
+from my_migrations import schema_snapshot
+
+schema = {
+    'Article': {
+        'fields': {'title': 'varchar(50)'},
+        'relations': {'Category': 'one', 'Tag': 'many'},
+        'indexes': ['title', 'Category', ['title'], ['Category', 'title']],
+    },
+    'Category': {'fields': {'title': 'varchar(50)'}, 'relations': {'Article': 'many'}},
+    'Tag': {'fields': {'value': 'varchar(50)'}, 'relations': {'Article': 'many'}},
+}
+
+
+def test_declared_indexes_are_created_once():
+    queries = Generator(schema).generate_scheme()
+    names = [name for query in queries for name in re.findall(r'CREATE INDEX "(\w+)"', query)]
+    assert sorted(names) == ['ix_article__tag_tag_id', 'ix_article_article_title',
+                             'ix_article_category_id', 'ix_article_category_id_article_title']
+    assert sorted(names) == sorted(schema_snapshot(schema)['indexes'])
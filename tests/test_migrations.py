@@ -0,0 +1,82 @@
+import copy
+
+from my_migrations import Migration, schema_snapshot
+
+
+def schema(**article_fields):
+    fields = {'title': 'varchar(50)'}
+    fields.update(article_fields)
+    return {
+        'Article': {'fields': fields, 'relations': {'Category': 'one'}},
+        'Category': {'fields': {'title': 'varchar(50)'}, 'relations': {'Article': 'many'}},
+    }
+
+
+def migrate(current, raw_dict, **options):
+    return Migration(current, raw_dict, **options).generate_migration()
+
+
+def test_same_schema_needs_no_statements():
+    assert migrate(schema_snapshot(schema()), schema()) == []
+
+
+def test_new_column_is_added():
+    queries = migrate(schema_snapshot(schema()), schema(text='text'))
+    assert queries == ['ALTER TABLE "article" ADD COLUMN "article_text" text;']
+
+
+def test_widened_column_changes_its_type_in_place():
+    current = schema_snapshot(schema())
+    current['tables']['article']['columns']['article_title'] = 'character varying(20)'
+    queries = migrate(current, schema())
+    assert queries == ['ALTER TABLE "article" ALTER COLUMN "article_title" TYPE character varying(50);']
+
+
+def test_narrowed_column_is_rewritten_in_batches():
+    current = schema_snapshot(schema())
+    current['tables']['article']['columns']['article_title'] = 'character varying(100)'
+    queries = migrate(current, schema())
+    assert queries[0] == 'ALTER TABLE "article" ADD COLUMN "article_title__new" character varying(50);'
+    assert not any('ALTER COLUMN' in query for query in queries)
+    assert 'RENAME COLUMN "article_title__new" TO "article_title"' in queries[-1]
+
+
+def test_outdated_triggers_are_replaced():
+    current = schema_snapshot(schema())
+    current['triggers'] = {'article': 'same_second'}
+    queries = migrate(current, schema())
+    assert len(queries) == 2
+    assert queries[0].startswith('CREATE OR REPLACE FUNCTION update_article_timestamp()')
+    assert 'CREATE TRIGGER' not in queries[0]
+    assert 'CREATE TRIGGER "tr_category_updated"' in queries[1]
+
+    del current['triggers']
+    queries = migrate(current, schema())
+    assert len(queries) == 2
+    assert not any('CREATE TRIGGER' in query for query in queries)
+
+
+def test_foreign_keys_of_new_tables_are_not_validated_later():
+    raw_dict = schema()
+    raw_dict['Category']['relations']['Section'] = 'one'
+    raw_dict['Section'] = {'fields': {'title': 'varchar(50)'}, 'relations': {'Category': 'many'}}
+    raw_dict['Article']['relations']['Tag'] = 'many'
+    raw_dict['Tag'] = {'fields': {'value': 'varchar(50)'}, 'relations': {'Article': 'many'}}
+    queries = migrate(schema_snapshot(schema()), raw_dict)
+
+    existing = [query for query in queries if '"fk_category_section_id"' in query]
+    assert existing[0].endswith('REFERENCES "section" ("section_id") NOT VALID;')
+    assert existing[1] == 'ALTER TABLE "category" VALIDATE CONSTRAINT "fk_category_section_id";'
+
+    new = [query for query in queries if '"fk_article__tag_' in query]
+    assert len(new) == 2
+    assert not any('NOT VALID' in query or 'VALIDATE' in query for query in new)
+
+
+def test_removed_tables_and_columns_are_dropped_only_when_allowed():
+    current = schema_snapshot(schema(text='text'))
+    current['tables']['legacy'] = copy.deepcopy(current['tables']['category'])
+    assert migrate(current, schema()) == []
+
+    queries = migrate(current, schema(), allow_drop=True)
+    assert queries == ['ALTER TABLE "article" DROP COLUMN "article_text";', 'DROP TABLE "legacy";']
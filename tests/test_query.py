@@ -0,0 +1,36 @@
+from my_entity import Entity, Max
+from tests.fake_db import FakeConnection
+
+
+class Essay(Entity):
+    __slots__ = ()
+    _columns = ['title', 'body']
+    _parents = []
+    _children = {}
+    _siblings = {}
+    _deferred = ['body']
+
+
+def respond(query, args):
+    if 'pg_attribute' in query:
+        return [['essay_id', 'integer'], ['essay_title', 'text'], ['essay_body', 'text'],
+                ['essay_created', 'timestamp'], ['essay_updated', 'timestamp']]
+    if query.startswith('SELECT max('):
+        return [{'longest': 'z'}]
+    return []
+
+
+def test_select_leaves_out_deferred_columns():
+    Entity.db = FakeConnection(respond)
+    query, args = Essay.query().filter(title='a').sql()
+    assert '"essay_body"' not in query
+    assert '"essay_title"' in query
+    assert args == ('a',)
+
+
+def test_aggregate_selects_deferred_columns():
+    db = FakeConnection(respond)
+    Entity.db = db
+    assert Essay.query().filter(title='a').only('title').aggregate(longest=Max('body')) == {'longest': 'z'}
+    query = db.queries[-1]
+    assert query.startswith('SELECT max("essay".essay_body) AS "longest" FROM (SELECT * FROM "essay" WHERE ')
@@ -0,0 +1,175 @@
+import psycopg2
+import pytest
+
+import my_entity
+from my_entity import Entity, ReplicaRouter
+from tests.fake_db import FakeConnection
+
+
+class Memo(Entity):
+    __slots__ = ()
+    _columns = ['text']
+    _parents = []
+    _children = {}
+    _siblings = {}
+
+
+def rows(query, args):
+    return [{'memo_id': 1, 'memo_text': 'a'}] if query.startswith('SELECT') else []
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(my_entity.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def replicas():
+    # connections by dsn, a test can replace respond of a replica to make it fail
+    connections = {}
+
+    def connect(dsn):
+        connections[dsn] = FakeConnection(rows, name=dsn)
+        return connections[dsn]
+
+    Entity.db = FakeConnection(rows, name='primary')
+    return connections, connect
+
+
+def reader():
+    # return the name of the connection which served a read
+    before = {id(db): len(db.queries) for db in reader.connections()}
+    Memo.all()
+    return next(db.name for db in reader.connections() if len(db.queries) > before.get(id(db), 0))
+
+
+def test_round_robin_takes_replicas_in_turn(replicas):
+    connections, connect = replicas
+    Entity.replicas = ReplicaRouter(['r1', 'r2'], connect=connect)
+    reader.connections = lambda: [Entity.db] + list(connections.values())
+
+    assert [reader() for _ in range(4)] == ['r1', 'r2', 'r1', 'r2']
+    assert all(db.autocommit for db in connections.values())
+
+
+def test_least_loaded_skips_busy_replicas(replicas):
+    connections, connect = replicas
+    router = ReplicaRouter(['r1', 'r2'], strategy='least_loaded', connect=connect)
+    Entity.replicas = router
+    reader.connections = lambda: [Entity.db] + list(connections.values())
+
+    busy = router.getconn()
+    assert router.load()[busy[0]] == 1
+    other = 'r2' if busy[0] == 'r1' else 'r1'
+    assert [reader() for _ in range(3)] == [other] * 3
+
+    router.putconn(*busy)
+    assert router.load() == {'r1': 0, 'r2': 0}
+
+
+def test_writes_pin_reads_to_the_primary(replicas, clock):
+    connections, connect = replicas
+    Entity.replicas = ReplicaRouter(['r1'], pin_seconds=5, connect=connect)
+    reader.connections = lambda: [Entity.db] + list(connections.values())
+
+    Memo(1).delete()
+    assert reader() == 'primary'
+    clock.now += 5
+    assert reader() == 'r1'
+
+
+def test_session_pins_reads_when_it_commits(replicas, clock):
+    connections, connect = replicas
+    Entity.replicas = ReplicaRouter(['r1'], pin_seconds=5, connect=connect)
+    reader.connections = lambda: [Entity.db] + list(connections.values())
+
+    with Entity.transaction():
+        Memo(1).delete()
+        assert reader() == 'primary'
+        clock.now += 60
+    assert reader() == 'primary'
+    clock.now += 5
+    assert reader() == 'r1'
+
+
+def test_failing_replica_falls_back_to_the_primary(replicas, clock):
+    connections, connect = replicas
+    failing = []
+
+    def fail(query, args):
+        raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    def connect_failing(dsn):
+        db = connect(dsn)
+        if failing:
+            db.respond = fail
+        return db
+
+    Entity.replicas = ReplicaRouter(['r1'], retry_seconds=30, connect=connect_failing)
+    reader.connections = lambda: [Entity.db] + list(connections.values())
+    failing.append(True)
+
+    assert reader() == 'primary'
+    assert connections['r1'].closed
+    # the replica is skipped until retry_seconds pass
+    assert reader() == 'primary'
+    assert len(connections['r1'].queries) == 1
+
+    failing.clear()
+    clock.now += 30
+    assert reader() == 'r1'
+
+
+def test_unavailable_replicas_read_from_the_primary(replicas):
+    def refuse(dsn):
+        raise psycopg2.OperationalError('could not connect to server')
+
+    Entity.replicas = ReplicaRouter(['r1', 'r2'], connect=refuse)
+    reader.connections = lambda: [Entity.db]
+    assert reader() == 'primary'
+    assert Entity.replicas.getconn() is None
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        ReplicaRouter(['r1'], strategy='random')
+
+
+class Pool(object):
+    def __init__(self):
+        self.taken = []
+
+    def getconn(self):
+        self.taken.append(FakeConnection(rows, name='pooled'))
+        return self.taken[-1]
+
+    def putconn(self, db):
+        pass
+
+
+def test_replica_reads_keep_identity_without_a_pooled_connection(replicas):
+    connections, connect = replicas
+    Entity.db = None
+    Entity.pool = Pool()
+    Entity.replicas = ReplicaRouter(['r1'], connect=connect)
+    try:
+        memo = Memo.all()[0]
+        assert Memo.all()[0] is memo
+        assert Entity.pool.taken == []
+
+        memo.text = 'b'
+        memo.save()
+        assert len(Entity.pool.taken) == 1
+        assert Memo.all()[0] is memo
+    finally:
+        Entity.release_connection()